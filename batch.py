@@ -0,0 +1,273 @@
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import json
+import sys
+from os import makedirs, path
+
+import cv2
+
+from engine import (CATEGORY_COMPONENTS, COLOR_MODES, ImageProcessor, Mixer, SpectrumCache,
+                    compute_fourier_transforms, spectrum_cache, to_bgr, validate_selection)
+from fft_backends import FFT_BACKENDS, PRECISIONS, get_backend
+from loader import image_store
+from masks import REGION_EDGES, REGION_SHAPES, apply_region, region_is_symmetric
+from session import is_session, load_session
+import timing
+
+# Headless batch mode: mixes every job of a JSON manifest without Qt.
+#
+# Manifest layout (job keys override the top-level defaults):
+# {
+#     "category": "Magnitude & Phase",
+#     "color_mode": "gray" | "rgb" | "ycbcr",
+#     "region": {"mode": "none" | "inner" | "outer", "size": 1-10,
+#                "shape": "rectangle" | "circle" | "ring",
+#                "edge": "hard" | "gaussian" | "butterworth"},
+#     "jobs": [
+#         {"images": ["a.jpg", "b.jpg"],
+#          "components": ["FT Magnitude", "FT Phase"],
+#          "weights": [1.0, 1.0],
+#          "output": "out/a_b.png"}
+#     ]
+# }
+# Weights are fractions in [0, 1]; "inner" keeps the low frequencies inside the
+# region and "outer" keeps the high frequencies outside it, like the GUI.
+
+REGION_MODES = ('none', 'inner', 'outer')
+
+
+def job_settings(job, defaults):
+    # Job keys merged over the manifest defaults, validated
+    region = dict(defaults.get('region', {}))
+    region.update(job.get('region', {}))
+    settings = {
+        'category': job.get('category', defaults.get('category', 'Magnitude & Phase')),
+        'color_mode': job.get('color_mode', defaults.get('color_mode', 'gray')),
+        'mode': region.get('mode', 'none'),
+        'size': region.get('size', 0),
+        'region_shape': region.get('shape', 'rectangle'),
+        'edge': region.get('edge', 'hard'),
+        'images': job['images'],
+        'components': job['components'],
+        'weights': job['weights'],
+    }
+
+    if settings['category'] not in CATEGORY_COMPONENTS:
+        raise ValueError(f"Unknown category: {settings['category']}")
+    if settings['color_mode'] not in COLOR_MODES:
+        raise ValueError(f"Unknown color mode: {settings['color_mode']}")
+    if settings['mode'] not in REGION_MODES:
+        raise ValueError(f"Unknown region mode: {settings['mode']}")
+    if settings['region_shape'] not in REGION_SHAPES or settings['edge'] not in REGION_EDGES:
+        raise ValueError(
+            f"Unknown region shape or edge: {settings['region_shape']}, {settings['edge']}")
+    if not 0 < len(settings['images']) <= 4 or \
+            not len(settings['images']) == len(settings['components']) == len(settings['weights']):
+        raise ValueError('Each job needs 1-4 images with one component and weight each.')
+    warning = validate_selection(settings['category'], settings['components'])
+    if warning:
+        raise ValueError(warning)
+    return settings
+
+
+class BatchMixer:
+    def __init__(self, base_dir='', backend=None, cache=None):
+        # cache: spectrum cache of the transformed images, the shared one by
+        # default
+        self.base_dir = base_dir
+        self.backend = backend
+        self.cache = cache
+        self.processors = {}
+
+    def add_session(self, session):
+        # Use a saved session's working images and spectra for its slots
+        for index in session.loaded():
+            processor = session.processors[index]
+            height, width = processor.image.shape[:2]
+            slot_id = session.slot_id(index)
+            self.processors[(slot_id, session.color_mode, None)] = processor
+            self.processors[(slot_id, session.color_mode, (width, height))] = processor
+
+    def resolve(self, file_path):
+        return file_path if path.isabs(file_path) else path.join(self.base_dir, file_path)
+
+    def decode(self, image_path, color_mode):
+        key = (image_path, color_mode, None)
+        if key not in self.processors:
+            processor = ImageProcessor(self.resolve(image_path), color_mode=color_mode)
+            if processor.image is None:
+                raise ValueError(f'Could not read image: {image_path}')
+            self.processors[key] = processor
+        return self.processors[key]
+
+    def load(self, image_paths, color_mode, target_size):
+        # Decode and transform each (file, mode, size) once per run; the new
+        # spectra of a set are computed in one batched FFT
+        processors = []
+        for image_path in image_paths:
+            key = (image_path, color_mode, target_size)
+            if key not in self.processors:
+                decoded = self.decode(image_path, color_mode)
+                image = decoded.image
+                if image.shape[:2] != (target_size[1], target_size[0]):
+                    image = decoded.source.resize(target_size)
+                self.processors[key] = ImageProcessor(
+                    image=image, cache=self.cache, backend=self.backend, color_mode=color_mode)
+            processors.append(self.processors[key])
+        compute_fourier_transforms([processor for processor in processors
+                                    if processor.spectrum is None])
+        return processors
+
+    def common_size(self, image_paths, color_mode):
+        # Size (width, height) of the smallest image of the set
+        shapes = [self.decode(image_path, color_mode).image.shape[:2]
+                  for image_path in image_paths]
+        height, width = min(shapes, key=lambda shape: shape[0] * shape[1])
+        return width, height
+
+    def run_job(self, job, defaults):
+        # Mixed image of one job, in the job's color mode
+        settings = job_settings(job, defaults)
+        target_size = self.common_size(settings['images'], settings['color_mode'])
+        processors = self.load(settings['images'], settings['color_mode'], target_size)
+        components = [processor.get_component(name)
+                      for processor, name in zip(processors, settings['components'])]
+        return mix_components(components, settings, self.backend)
+
+
+def job_mixer(components, settings, backend=None):
+    # Mixer holding one unmasked component per image, with a job's region
+    # applied and its weights set
+    mode, size = settings['mode'], settings['size']
+    region_shape, edge = settings['region_shape'], settings['edge']
+    mixer = Mixer(backend)
+    for index, (component, weight) in enumerate(zip(components, settings['weights'])):
+        symmetric = True
+        if mode != 'none':
+            component = apply_region(component, size, mode == 'outer',
+                                     region_shape, edge)
+            symmetric = region_is_symmetric(component.shape[-2:], size, mode == 'outer',
+                                            region_shape, edge)
+        mixer.set_component(index, component, symmetric)
+        mixer.weights[index] = float(weight)
+    return mixer
+
+
+def mix_components(components, settings, backend=None):
+    # Mix one unmasked component per image with a job's region and weights
+    mixer = job_mixer(components, settings, backend)
+    return mixer.mix_images(settings['category'], settings['components'])
+
+
+def output_path(job, number, base_dir='', output_dir=None):
+    output = job.get('output', f'mix_{number:05d}.png')
+    if output_dir is not None:
+        return path.join(output_dir, output)
+    if not path.isabs(output):
+        return path.join(base_dir, output)
+    return output
+
+
+def write_output(output, mixed_image, color_mode):
+    if path.dirname(output):
+        makedirs(path.dirname(output), exist_ok=True)
+    cv2.imwrite(output, to_bgr(mixed_image, color_mode))
+
+
+def run_manifest(manifest, base_dir='', output_dir=None, backend=None, batch_mixer=None):
+    batch_mixer = batch_mixer or BatchMixer(base_dir, backend)
+    timings = []
+    for number, job in enumerate(manifest['jobs']):
+        output = output_path(job, number, base_dir, output_dir)
+
+        started = time.perf_counter()
+        mixed_image = batch_mixer.run_job(job, manifest)
+        timings.append(time.perf_counter() - started)
+        timing.flush(f'job {number}')
+
+        write_output(output, mixed_image, job_settings(job, manifest)['color_mode'])
+    return timings
+
+
+def summarize(startup, timings, total):
+    mixes = len(timings)
+    return {
+        'startup_s': startup,
+        'mixes': mixes,
+        'total_s': total,
+        'mean_mix_ms': 1000 * sum(timings) / mixes if mixes else 0.0,
+        'max_mix_ms': 1000 * max(timings) if mixes else 0.0,
+        'mixes_per_s': mixes / total if total else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Mix image sets from a JSON manifest without the GUI.')
+    parser.add_argument('manifest', help='Path to the JSON manifest, or a saved session '
+                                         'directory to mix its slots.')
+    parser.add_argument('-o', '--output-dir',
+                        help='Directory for outputs (default: relative to the manifest).')
+    parser.add_argument('--report', help='Write the timing summary as JSON to this path.')
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help='Memory budget of the spectrum cache in MiB.')
+    parser.add_argument('--memory-mb', type=int, default=2048,
+                        help='Memory ceiling for decoding and working copies in MiB; '
+                             'larger images are mixed at a reduced working resolution.')
+    parser.add_argument('--fft', choices=sorted(FFT_BACKENDS), default='numpy',
+                        help='FFT engine (scipy and pyfftw need their packages).')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double')
+    parser.add_argument('--workers', type=int, help='Threads for the scipy/pyfftw engines.')
+    parser.add_argument('--complex-fft', action='store_true',
+                        help='Use full complex FFTs instead of real-input transforms.')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help='Worker processes mixing jobs in parallel (0: one per core).')
+    parser.add_argument('--parallel-memory-mb', type=int, default=4096,
+                        help='Memory cap of the parallel mode (shared spectra and workers) in MiB.')
+    parser.add_argument('--timing', action='store_true',
+                        help='Log the time of every pipeline stage per job.')
+    args = parser.parse_args(argv)
+    if args.timing:
+        timing.enable()
+    spectrum_cache.budget_bytes = args.cache_mb << 20
+    image_store.memory_limit = args.memory_mb << 20
+    backend = get_backend(args.fft, args.precision, not args.complex_fft, args.workers)
+
+    base_dir = path.dirname(path.abspath(args.manifest))
+    # The parallel path keeps spectra in shared memory, not in the cache
+    batch_mixer = BatchMixer(base_dir, backend,
+                             None if args.processes == 1 else SpectrumCache(0))
+    if is_session(args.manifest):
+        session = load_session(args.manifest, backend)
+        manifest = session.manifest()
+        batch_mixer.add_session(session)
+    else:
+        with open(args.manifest) as manifest_file:
+            manifest = json.load(manifest_file)
+    startup = time.perf_counter() - _START
+
+    started = time.perf_counter()
+    if args.processes == 1:
+        timings = run_manifest(manifest, base_dir, args.output_dir, backend, batch_mixer)
+    else:
+        from parallel import run_manifest_parallel
+        timings = run_manifest_parallel(manifest, base_dir, args.output_dir, backend,
+                                        args.processes or None, args.parallel_memory_mb << 20,
+                                        batch_mixer)
+    summary = summarize(startup, timings, time.perf_counter() - started)
+
+    print(f"startup: {summary['startup_s'] * 1000:.1f} ms")
+    print(f"mixes: {summary['mixes']} in {summary['total_s']:.2f} s "
+          f"({summary['mixes_per_s']:.1f} mixes/s, mean {summary['mean_mix_ms']:.1f} ms, "
+          f"max {summary['max_mix_ms']:.1f} ms)")
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
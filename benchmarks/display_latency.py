@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import time
+from os import path
+
+import numpy as np
+
+# Display latency of a mixed image against its size: the zero-copy QImage path
+# used by MainApp.display_mixed_image versus the old per-pixel QPainter loop.
+#
+#     python benchmarks/display_latency.py --sizes 256 512 1024 2048 4096
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QColor, QPainter, QPixmap
+from PyQt5.QtWidgets import QApplication
+
+from main import array_to_qimage
+
+
+def display_zero_copy(mixed_image, size):
+    q_image = array_to_qimage(mixed_image)
+    return QPixmap.fromImage(q_image).scaled(size, Qt.KeepAspectRatio)
+
+
+def display_per_pixel(mixed_image, size):
+    height, width = mixed_image.shape
+    pixmap = QPixmap(width, height)
+    pixmap.fill(QColor(255, 255, 255))
+    painter = QPainter(pixmap)
+    for y in range(height):
+        for x in range(width):
+            pixel_value = int(mixed_image[y][x])
+            painter.setPen(QColor(pixel_value, pixel_value, pixel_value))
+            painter.drawPoint(x, y)
+    painter.end()
+    return pixmap.scaled(size, Qt.KeepAspectRatio)
+
+
+def measure(display, mixed_image, size, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        display(mixed_image, size)
+        timings.append(time.perf_counter() - started)
+    return 1000 * float(np.median(timings))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time mixed-image display against image size.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--legacy-max', type=int, default=512,
+                        help='Largest size timed with the per-pixel loop (it is very slow).')
+    parser.add_argument('--widget', type=int, nargs=2, default=[400, 400],
+                        help='Output viewer size the pixmap is scaled to.')
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    size = QSize(*args.widget)
+    rng = np.random.default_rng(0)
+
+    print(f"{'size':>6} {'zero-copy ms':>13} {'per-pixel ms':>13} {'speedup':>8}")
+    for side in args.sizes:
+        mixed_image = rng.integers(0, 256, (side, side), dtype=np.uint8)
+        fast = measure(display_zero_copy, mixed_image, size, args.repeat)
+        if side <= args.legacy_max:
+            slow = measure(display_per_pixel, mixed_image, size, 1)
+            print(f'{side:>6} {fast:>13.2f} {slow:>13.1f} {slow / fast:>7.0f}x')
+        else:
+            print(f"{side:>6} {fast:>13.2f} {'-':>13} {'-':>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
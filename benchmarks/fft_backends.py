@@ -0,0 +1,109 @@
+import argparse
+import sys
+import time
+from os import path
+
+import numpy as np
+
+# Compares the FFT engines: per-mix time and spectrum memory of every available
+# backend and precision, with real-input or full complex transforms, and checks
+# each output against the original float64 fft2/ifft2 mixer.
+#
+#     python benchmarks/fft_backends.py --sizes 512 1024 2048
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+
+from engine import ImageProcessor, Mixer, SpectrumCache
+from fft_backends import PRECISIONS, available_backends, get_backend
+from masks import apply_region, region_is_symmetric
+
+CATEGORY = 'Magnitude & Phase'
+NAMES = ['FT Magnitude', 'FT Phase', 'FT Magnitude', 'FT Phase']
+WEIGHTS = [0.7, 0.4, 0.3, 0.6]
+
+
+def reference_mix(images, region):
+    # The mixer as it was before pluggable backends: complex128 throughout
+    spectra = [np.fft.fftshift(np.fft.fft2(image)) for image in images]
+    components = [np.abs(spectrum) if name == 'FT Magnitude' else np.angle(spectrum)
+                  for spectrum, name in zip(spectra, NAMES)]
+    if region:
+        components = [apply_region(component, *region) for component in components]
+    comp1 = sum(w * c for w, c, n in zip(WEIGHTS, components, NAMES) if n == 'FT Magnitude')
+    comp2 = sum(w * c for w, c, n in zip(WEIGHTS, components, NAMES) if n == 'FT Phase')
+    mixed_image = np.abs(np.fft.ifft2(np.fft.ifftshift(comp1 * np.exp(1j * comp2))))
+    mixed_image -= mixed_image.min()
+    return (mixed_image / mixed_image.max() * 255).astype(np.uint8)
+
+
+def backend_mix(images, region, backend):
+    mixer = Mixer(backend)
+    processors = []
+    for index, image in enumerate(images):
+        processor = ImageProcessor(image=image, cache=SpectrumCache(), backend=backend)
+        processor.compute_fourier_transform()
+        processors.append(processor)
+        component = processor.get_component(NAMES[index])
+        symmetric = True
+        if region:
+            component = apply_region(component, *region)
+            symmetric = region_is_symmetric(component.shape[-2:], *region)
+        mixer.set_component(index, component, symmetric)
+        mixer.weights[index] = WEIGHTS[index]
+    started = time.perf_counter()
+    mixed_image = mixer.mix_images(CATEGORY, NAMES)
+    return mixed_image, time.perf_counter() - started, processors
+
+
+def load_images(side):
+    if side is None:
+        files = ['1.jpg', '2.jpg', '3.jpg', '4.jpg']
+        images = [cv2.imread(path.join(ROOT, 'dataset', name), cv2.IMREAD_GRAYSCALE)
+                  for name in files]
+        height, width = min(image.shape for image in images)
+        return [cv2.resize(image, (width, height)) for image in images]
+    rng = np.random.default_rng(side)
+    return [rng.integers(0, 256, (side, side), dtype=np.uint8) for _ in range(4)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time and check the FFT backends against the original mixer.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048],
+                        help='Synthetic square image sizes (the dataset images always run).')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    configs = [(name, precision, real)
+               for name in available_backends()
+               for precision in PRECISIONS
+               for real in (True, False)]
+    # Region settings: none, an inner and an outer rectangle
+    regions = [None, (4, False), (3, True)]
+
+    print(f"{'image':>9} {'backend':>8} {'precision':>9} {'fft':>7} {'region':>8} "
+          f"{'mix ms':>8} {'spectrum MB':>11} {'max diff':>8}")
+    for side in [None] + args.sizes:
+        images = load_images(side)
+        label = 'dataset' if side is None else f'{side}^2'
+        for region in regions:
+            reference = reference_mix(images, region)
+            for name, precision, real in configs:
+                backend = get_backend(name, precision, real)
+                timings = []
+                for _ in range(args.repeat):
+                    mixed_image, elapsed, processors = backend_mix(images, region, backend)
+                    timings.append(elapsed)
+                spectrum_mb = sum(p.spectrum.nbytes for p in processors) / 2 ** 20
+                diff = int(np.abs(mixed_image.astype(int) - reference).max())
+                print(f"{label:>9} {name:>8} {precision:>9} {'real' if real else 'complex':>7} "
+                      f"{str(region):>8} {1000 * min(timings):>8.1f} {spectrum_mb:>11.1f} "
+                      f"{diff:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
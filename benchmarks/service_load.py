@@ -0,0 +1,162 @@
+import argparse
+import http.client
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from os import path
+
+import numpy as np
+
+# Load test of the mixing service: uploads the dataset images, then keeps a
+# number of clients sending mix requests with random weights, and reports
+# the client-side p50/p90/p99 latency, requests per second, rejections
+# (503, backpressure) and how the service batched the requests.
+#
+#     python benchmarks/service_load.py --clients 8 --duration 10
+#     python benchmarks/service_load.py --url http://127.0.0.1:8765
+#     python benchmarks/service_load.py --socket /tmp/harmonize.sock
+#
+# Without --url or --socket a service is started in this process.
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DATASET = ['1.jpg', '2.jpg', '3.jpg', '4.jpg']
+NAMES = ['FT Magnitude', 'FT Phase', 'FT Magnitude', 'FT Phase']
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def connect(args):
+    if args.socket:
+        return UnixHTTPConnection(args.socket)
+    url = http.client.urlsplit(args.url)
+    return http.client.HTTPConnection(url.hostname, url.port)
+
+
+def call(connection, method, route, body=None, content_type='application/json'):
+    headers = {'Content-Type': content_type} if body is not None else {}
+    connection.request(method, route, body, headers)
+    response = connection.getresponse()
+    return response.status, response.read(), response
+
+
+def upload_dataset(args):
+    connection = connect(args)
+    ids = []
+    for name in DATASET:
+        with open(path.join(ROOT, 'dataset', name), 'rb') as image_file:
+            status, body, _ = call(connection, 'POST', '/images', image_file.read(),
+                                   'application/octet-stream')
+        if status != 201:
+            raise RuntimeError(f'Upload failed ({status}): {body.decode()}')
+        ids.append(json.loads(body)['id'])
+    connection.close()
+    return ids
+
+
+def client(args, ids, stop, results, seed):
+    rng = random.Random(seed)
+    connection = connect(args)
+    while not stop.is_set():
+        job = {
+            'images': ids,
+            'components': NAMES,
+            'weights': [round(rng.random(), 2) for _ in ids],
+            'color_mode': args.color_mode,
+            'region': {'mode': args.region, 'size': rng.randint(1, 10),
+                       'shape': 'circle', 'edge': 'gaussian'},
+            'format': 'raw',
+        }
+        started = time.perf_counter()
+        try:
+            status, _, response = call(connection, 'POST', '/mix', json.dumps(job).encode())
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = connect(args)
+            results.append(('error', time.perf_counter() - started, 0))
+            continue
+        batch_size = int(response.getheader('X-Batch-Size', 0))
+        results.append((status, time.perf_counter() - started, batch_size))
+        if status == 503:
+            # Back off as the service asks
+            time.sleep(float(response.getheader('Retry-After', 1)) / 10)
+    connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the local mixing service.')
+    parser.add_argument('--url', help='Address of a running service.')
+    parser.add_argument('--socket', help='Unix socket of a running service.')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load.')
+    parser.add_argument('--color-mode', choices=['gray', 'rgb', 'ycbcr'], default='gray')
+    parser.add_argument('--region', choices=['none', 'inner', 'outer'], default='inner')
+    parser.add_argument('--max-batch', type=int, default=16,
+                        help='Batch size of the in-process service.')
+    parser.add_argument('--report', help='Write the results as JSON to this path.')
+    args = parser.parse_args(argv)
+
+    if not args.url and not args.socket:
+        from service import MixService, serve
+        service = MixService(max_batch=args.max_batch).start()
+        server = serve(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.url = 'http://%s:%d' % server.server_address[:2]
+
+    ids = upload_dataset(args)
+    results, stop = [], threading.Event()
+    clients = [threading.Thread(target=client, args=(args, ids, stop, results, seed))
+               for seed in range(args.clients)]
+    started = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    completed = [(latency, batch_size) for status, latency, batch_size in results if status == 200]
+    latencies = 1000 * np.array([latency for latency, _ in completed] or [0.0])
+    summary = {
+        'clients': args.clients,
+        'completed': len(completed),
+        'rejected': sum(1 for status, _, _ in results if status == 503),
+        'failed': sum(1 for status, _, _ in results if status not in (200, 503)),
+        'requests_per_s': len(completed) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_batch_size': float(np.mean([size for _, size in completed] or [0])),
+    }
+    connection = connect(args)
+    status, body, _ = call(connection, 'GET', '/metrics')
+    connection.close()
+    if status == 200:
+        summary['service'] = json.loads(body)
+
+    print(f"{summary['completed']} mixes in {elapsed:.1f} s from {args.clients} clients: "
+          f"{summary['requests_per_s']:.1f} requests/s, p50 {summary['p50_ms']:.1f} ms, "
+          f"p90 {summary['p90_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms")
+    print(f"rejected (503): {summary['rejected']}, failed: {summary['failed']}, "
+          f"mean batch size: {summary['mean_batch_size']:.1f}")
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
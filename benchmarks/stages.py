@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from os import path
+
+import numpy as np
+
+# Per-stage cost of the mixing pipeline, from the forward FFT to showing the
+# mix, over the bundled dataset and synthetic images. Reports latency
+# percentiles, the peak memory each stage allocates (numpy allocations, as
+# traced by tracemalloc) and what it keeps, and saves or compares JSON
+# baselines.
+#
+#     python benchmarks/stages.py --save baseline.json
+#     python benchmarks/stages.py --compare baseline.json
+#
+# The largest default size, 8192^2, needs several GB for its four spectra;
+# pass --sizes to stay below that.
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+from PyQt5.QtWidgets import QApplication
+
+from engine import (CATEGORY_COMPONENTS, ImageProcessor, Mixer, SpectrumCache,
+                    compute_fourier_transforms)
+from fft_backends import FFT_BACKENDS, PRECISIONS, get_backend
+
+CATEGORY = 'Magnitude & Phase'
+NAMES = ['FT Magnitude', 'FT Phase', 'FT Magnitude', 'FT Phase']
+WEIGHTS = [0.7, 0.4, 0.3, 0.6]
+# Inner circle with a soft edge: the mask is not a plain copy
+REGION = (4, False, 'circle', 'gaussian')
+STAGES = ('fft', 'mask', 'normalize', 'shade', 'create_mixed_components',
+          'weight_update', 'mix_and_reconstruct', 'display')
+
+
+def load_images(side):
+    if side is None:
+        files = ['1.jpg', '2.jpg', '3.jpg', '4.jpg']
+        images = [cv2.imread(path.join(ROOT, 'dataset', name), cv2.IMREAD_GRAYSCALE)
+                  for name in files]
+        height, width = min(image.shape for image in images)
+        return [cv2.resize(image, (width, height)) for image in images]
+    rng = np.random.default_rng(side)
+    return [rng.integers(0, 256, (side, side), dtype=np.uint8) for _ in range(4)]
+
+
+class Pipeline:
+    # The GUI's stages for one image set, each runnable on its own
+    def __init__(self, images, backend, window):
+        self.images = images
+        self.backend = backend
+        self.window = window
+        self.viewer = window.image_viewers[0]
+        self.processors = self.new_processors()
+        compute_fourier_transforms(self.processors)
+        self.components = [processor.get_component(name)
+                           for processor, name in zip(self.processors, NAMES)]
+        self.masked = [self.viewer.mask_component(component, REGION)[0].copy()
+                       for component in self.components]
+        self.normalized = self.viewer.fit_component(self.components[0])
+        self.mixer = self.new_mixer()
+        self.sums = self.mixer.create_mixed_components(*CATEGORY_COMPONENTS[CATEGORY], NAMES)
+        self.mixed_image = self.mixer.mix_and_reconstruct(*self.sums, CATEGORY)
+        self.step = 0
+
+    def new_processors(self):
+        return [ImageProcessor(image=image, cache=SpectrumCache(), backend=self.backend)
+                for image in self.images]
+
+    def new_mixer(self):
+        mixer = Mixer(self.backend)
+        for index, component in enumerate(self.masked):
+            mixer.set_component(index, component, symmetric=True)
+            mixer.weights[index] = WEIGHTS[index]
+        return mixer
+
+    def setup(self, name):
+        # Work done before a timed run that is not part of the stage
+        if name == 'fft':
+            return self.new_processors()
+        if name == 'create_mixed_components':
+            return self.new_mixer()
+        return None
+
+    def run(self, name, prepared):
+        if name == 'fft':
+            compute_fourier_transforms(prepared)
+        elif name == 'mask':
+            self.viewer.mask_component(self.components[0], REGION)
+        elif name == 'normalize':
+            self.viewer.fit_component(self.components[0])
+        elif name == 'shade':
+            self.viewer.shade_component(self.normalized, REGION)
+        elif name == 'create_mixed_components':
+            prepared.create_mixed_components(*CATEGORY_COMPONENTS[CATEGORY], NAMES)
+        elif name == 'weight_update':
+            # One slider step: the incremental update of a single weight
+            self.step += 1
+            self.mixer.weights[0] = WEIGHTS[0] + 0.01 * (self.step % 2)
+            self.mixer.create_mixed_components(*CATEGORY_COMPONENTS[CATEGORY], NAMES)
+        elif name == 'mix_and_reconstruct':
+            self.mixer.mix_and_reconstruct(*self.sums, CATEGORY)
+        elif name == 'display':
+            self.window.display_mixed_image(self.mixed_image)
+
+
+def measure(pipeline, name, repeat, budget):
+    # Latency percentiles over up to `repeat` runs (at least 3 when a run is
+    # slower than the time budget allows), then one traced run for memory
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat and (len(timings) < 3 or time.perf_counter() - started < budget):
+        prepared = pipeline.setup(name)
+        run_started = time.perf_counter()
+        pipeline.run(name, prepared)
+        timings.append(time.perf_counter() - run_started)
+
+    prepared = pipeline.setup(name)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    pipeline.run(name, prepared)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = 1000 * np.array(timings)
+    return {
+        'runs': len(timings),
+        'mean_ms': float(timings.mean()),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p90_ms': float(np.percentile(timings, 90)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'peak_mb': (peak - before) / 2 ** 20,
+        'retained_mb': (after - before) / 2 ** 20,
+    }
+
+
+def environment(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'fft': args.fft,
+        'precision': args.precision,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Median latency against the baseline; returns the regressions
+    regressions = []
+    print(f"\n{'image':>9} {'stage':>24} {'base p50':>9} {'p50':>9} {'ratio':>6}")
+    for image, stages in results.items():
+        for name, result in stages.items():
+            base = baseline.get('results', {}).get(image, {}).get(name)
+            if base is None:
+                continue
+            ratio = result['p50_ms'] / max(base['p50_ms'], 1e-6)
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = ' slower'
+                regressions.append((image, name, ratio))
+            elif ratio < 1 - tolerance:
+                flag = ' faster'
+            print(f"{image:>9} {name:>24} {base['p50_ms']:>9.2f} {result['p50_ms']:>9.2f} "
+                  f"{ratio:>6.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time every stage of the mixing pipeline and compare with a baseline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048, 4096, 8192],
+                        help='Synthetic square image sizes (the dataset images always run).')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per stage.')
+    parser.add_argument('--budget', type=float, default=5.0,
+                        help='Seconds per stage after which slow stages stop at 3 runs.')
+    parser.add_argument('--fft', choices=sorted(FFT_BACKENDS), default='numpy')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double')
+    parser.add_argument('--save', help='Write the results as a JSON baseline to this path.')
+    parser.add_argument('--compare', help='Baseline JSON to compare the results with.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative p50 change reported as slower or faster.')
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    from main import MainApp
+    window = MainApp()
+    window.show()
+    backend = get_backend(args.fft, args.precision)
+
+    results = {}
+    print(f"{'image':>9} {'stage':>24} {'runs':>5} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+          f"{'peak MB':>8} {'kept MB':>8}")
+    for side in [None] + args.sizes:
+        label = 'dataset' if side is None else f'{side}^2'
+        pipeline = Pipeline(load_images(side), backend, window)
+        results[label] = {}
+        for name in args.stages:
+            result = measure(pipeline, name, args.repeat, args.budget)
+            results[label][name] = result
+            print(f"{label:>9} {name:>24} {result['runs']:>5} {result['p50_ms']:>9.2f} "
+                  f"{result['p90_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+                  f"{result['peak_mb']:>8.1f} {result['retained_mb']:>8.1f}")
+        del pipeline
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+    print(f'\npeak process memory: {max_rss_mb:.0f} MB')
+    window.close()
+
+    report = {'environment': environment(args), 'max_rss_mb': max_rss_mb, 'results': results}
+    if args.save:
+        with open(args.save, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} stage(s) slower than the baseline')
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import argparse
+import sys
+import time
+from os import path
+
+import numpy as np
+
+# Throughput of parameter sweeps: the batched sweep against one Mixer call per
+# result, for a grid of two images' weights across region sizes, and the
+# largest pixel difference between the two.
+#
+#     python benchmarks/sweep.py --steps 11 --sizes 256 512
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+
+from batch import mix_components
+from engine import ImageProcessor, SpectrumCache, compute_fourier_transforms
+from fft_backends import PRECISIONS, get_backend
+from sweep import sweep, weight_grid
+
+GRIDS = {
+    'Magnitude & Phase': ['FT Magnitude', 'FT Phase'],
+    'Real & Imaginary': ['FT Real', 'FT Imaginary'],
+}
+
+
+def load_images(side):
+    if side is None:
+        images = [cv2.imread(path.join(ROOT, 'dataset', name), cv2.IMREAD_GRAYSCALE)
+                  for name in ('1.jpg', '2.jpg')]
+        height, width = min(image.shape for image in images)
+        return [cv2.resize(image, (width, height)) for image in images]
+    rng = np.random.default_rng(side)
+    return [rng.integers(0, 256, (side, side), dtype=np.uint8) for _ in range(2)]
+
+
+def loop_mixes(components, names, category, weights, regions, backend):
+    # One mix_components call per (region, weight vector), like a script would
+    images = []
+    for value, out, region_shape, edge in regions:
+        for vector in weights:
+            settings = {'category': category, 'mode': 'outer' if out else 'inner',
+                        'size': value, 'region_shape': region_shape, 'edge': edge,
+                        'components': names, 'weights': list(vector)}
+            with np.errstate(all='ignore'):
+                images.append(mix_components(components, settings, backend))
+    return images
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare sweeps with a loop of mixes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512],
+                        help='Synthetic square image sizes (the dataset images always run).')
+    parser.add_argument('--steps', type=int, default=11, help='Weight values per image.')
+    parser.add_argument('--regions', type=int, default=10, help='Region sizes, from 1.')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double')
+    args = parser.parse_args(argv)
+    backend = get_backend('numpy', args.precision)
+
+    values = list(np.linspace(0, 1, args.steps))
+    weights = weight_grid([values, values])
+    regions = [(size, False, 'circle', 'gaussian') for size in range(1, args.regions + 1)]
+    mixes = len(weights) * len(regions)
+    print(f'{len(regions)} regions x {len(weights)} weight vectors = {mixes} mixes')
+    print(f"{'image':>9} {'category':>18} {'loop/s':>9} {'sweep/s':>9} {'speedup':>8} {'max diff':>9}")
+    for side in [None] + args.sizes:
+        label = 'dataset' if side is None else f'{side}^2'
+        images = load_images(side)
+        for category, names in GRIDS.items():
+            processors = [ImageProcessor(image=image, cache=SpectrumCache(), backend=backend)
+                          for image in images]
+            compute_fourier_transforms(processors)
+            components = [processor.get_component(name)
+                          for processor, name in zip(processors, names)]
+
+            started = time.perf_counter()
+            looped = loop_mixes(components, names, category, weights, regions, backend)
+            loop_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            swept = np.empty((len(regions), len(weights)) + images[0].shape, np.uint8)
+            for region_indices, weight_indices, chunk in sweep(
+                    components, names, category, weights, regions, backend):
+                swept[np.ix_(region_indices, weight_indices)] = chunk
+            sweep_time = time.perf_counter() - started
+
+            # All-zero weights give an undefined (NaN) image in the mixer
+            nonzero = [index for index, vector in enumerate(np.tile(weights, (len(regions), 1)))
+                       if vector.any()]
+            difference = np.abs(np.stack(looped)[nonzero].astype(int)
+                                - swept.reshape(-1, *images[0].shape)[nonzero]).max()
+            print(f'{label:>9} {category:>18} {mixes / loop_time:>9.1f} '
+                  f'{mixes / sweep_time:>9.1f} {loop_time / sweep_time:>7.1f}x {difference:>9}')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
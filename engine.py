@@ -0,0 +1,415 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import timing
+from fft_backends import get_backend, half_index
+from loader import COLOR_CONVERSIONS, COLOR_MODES, fit_size, image_store
+
+# Headless mixing engine: everything here works on numpy arrays only, so it
+# can be imported (and driven from batch jobs) without pulling in PyQt5.
+
+CATEGORY_COMPONENTS = {
+    'Magnitude & Phase': ('FT Magnitude', 'FT Phase'),
+    'Real & Imaginary': ('FT Real', 'FT Imaginary'),
+}
+
+COMPONENT_FUNCTIONS = {
+    'FT Magnitude': np.abs,
+    'FT Phase': np.angle,
+    'FT Real': np.real,
+    'FT Imaginary': np.imag,
+}
+
+
+class SpectrumCache:
+    # Shifted complex spectra keyed by a hash of the image content, evicted in
+    # least-recently-used order once their total size exceeds the budget
+    def __init__(self, budget_bytes=1 << 30):
+        self.budget_bytes = budget_bytes
+        self.spectra = OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(image):
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16)
+        digest.update(repr((image.shape, image.dtype.str)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            spectrum = self.spectra.get(key)
+            if spectrum is not None:
+                self.spectra.move_to_end(key)
+            return spectrum
+
+    def put(self, key, spectrum):
+        spectrum.flags.writeable = False
+        with self.lock:
+            if key in self.spectra:
+                self.used_bytes -= self.spectra.pop(key).nbytes
+            self.spectra[key] = spectrum
+            self.used_bytes += spectrum.nbytes
+            # Always keep the newest entry, even if it alone exceeds the budget
+            while self.used_bytes > self.budget_bytes and len(self.spectra) > 1:
+                _, evicted = self.spectra.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+        return spectrum
+
+    def clear(self):
+        with self.lock:
+            self.spectra.clear()
+            self.used_bytes = 0
+
+
+spectrum_cache = SpectrumCache()
+
+# Engine used when an ImageProcessor or Mixer is not given one
+fft_backend = get_backend('numpy')
+
+
+def to_rgb(image, color_mode='gray'):
+    # Displayable version of an image (or mix) in the given color mode
+    if color_mode == 'ycbcr':
+        return cv2.cvtColor(image, cv2.COLOR_YCrCb2RGB)
+    return image
+
+
+def to_bgr(image, color_mode='gray'):
+    # Version of an image (or mix) for cv2.imwrite
+    if color_mode == 'gray':
+        return image
+    return cv2.cvtColor(image, COLOR_CONVERSIONS[color_mode][1])
+
+
+def compute_fourier_transforms(processors):
+    # Give every processor its spectrum; the images not found in the cache are
+    # stacked, channels first, and transformed in one batched FFT per shape
+    pending = {}
+    for processor in processors:
+        key = (processor.cache.key(processor.image), processor.backend.key)
+        spectrum = processor.cache.get(key)
+        if spectrum is None:
+            group = pending.setdefault((processor.image.shape, processor.backend), {})
+            group.setdefault(key, []).append(processor)
+        else:
+            processor.set_spectrum(spectrum)
+
+    for (_, backend), group in pending.items():
+        stack = np.stack([group[key][0].channels() for key in group])
+        # Compute the 2D Fourier Transforms with zero frequency at the center
+        with timing.stage('fft'):
+            spectra = backend.forward(stack)
+        for key, spectrum in zip(group, spectra):
+            if len(group) > 1:
+                # The cache charges each entry its own size, so it must not
+                # keep a view that holds the whole batch alive
+                spectrum = spectrum.copy()
+            spectrum = group[key][0].cache.put(key, spectrum)
+            for processor in group[key]:
+                processor.set_spectrum(spectrum)
+
+
+class ImageProcessor:
+    def __init__(self, image_path=None, image=None, cache=None, backend=None,
+                 color_mode='gray', store=None):
+        # Either load a file or wrap an already decoded array, which is
+        # (height, width) in gray mode and (height, width, 3) otherwise. Files
+        # keep their full-resolution original in the store; self.image is the
+        # working copy, capped by the store's memory ceiling.
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f'Unknown color mode: {color_mode}')
+        self.store = image_store if store is None else store
+        self.source = None
+        if image is None:
+            self.source = self.store.load(image_path, color_mode)
+            if self.source is not None:
+                channels = 1 if color_mode == 'gray' else 3
+                image = self.source.working_image(self.store.max_working_pixels(channels))
+        self.image_path = image_path
+        self.image = image
+        # Shape before any resize_image, to size the other slots against
+        self.working_shape = None if image is None else image.shape
+        self.color_mode = color_mode
+        self.cache = spectrum_cache if cache is None else cache
+        self.backend = fft_backend if backend is None else backend
+        self.spectrum = None
+        # Components are derived from the spectrum the first time they are asked for
+        self.fourier_components = {}
+
+    def resize_image(self, target_size):
+        # Resize from the original when there is one, so shrinking and growing
+        # again never compounds the loss
+        if self.source is not None:
+            self.image = self.source.resize(target_size)
+        else:
+            self.image = cv2.resize(self.image, target_size)
+
+    def thumbnail(self, max_width, max_height):
+        # Display-sized copy of the working image, taken from the original's
+        # pyramid when there is one
+        size = fit_size(self.image.shape, max_width, max_height)
+        if self.source is None:
+            image = cv2.resize(self.image, size, interpolation=cv2.INTER_AREA)
+        else:
+            image = self.source.resize(size)
+        return to_rgb(image, self.color_mode)
+
+    def channels(self):
+        # Image with channels first, the layout of spectra and components
+        if self.image.ndim == 3:
+            return self.image.transpose(2, 0, 1)
+        return self.image
+
+    def display_image(self):
+        return to_rgb(self.image, self.color_mode)
+
+    def compute_fourier_transform(self):
+        # Reuse the spectrum of identical image content when it is still cached
+        compute_fourier_transforms([self])
+
+    def set_spectrum(self, spectrum):
+        self.spectrum = spectrum
+        self.fourier_components = {}
+
+    def get_component(self, component_type):
+        # Get the specified Fourier transform component (Magnitude, Phase, Real, Imaginary)
+        if component_type not in self.fourier_components:
+            component = COMPONENT_FUNCTIONS[component_type](self.spectrum)
+            component.flags.writeable = False
+            self.fourier_components[component_type] = component
+        return self.fourier_components[component_type]
+
+
+def center_crop(spectrum, shape):
+    # View of the centered block of a shifted spectrum, keeping the zero
+    # frequency at the block's own fftshift center
+    height, width = spectrum.shape[-2:]
+    crop_height, crop_width = min(shape[0], height), min(shape[1], width)
+    top = height // 2 - crop_height // 2
+    left = width // 2 - crop_width // 2
+    return spectrum[..., top:top + crop_height, left:left + crop_width]
+
+
+def preview_shape(shape, scale, minimum=16):
+    # Shape of a preview at `scale` of the full resolution, keeping the aspect
+    height, width = shape[-2:]
+    return (min(height, max(minimum, round(height * scale))),
+            min(width, max(minimum, round(width * scale))))
+
+
+def normalize(mixed, image_axes):
+    # Scaling of mixes to 0-255 for every image of a stack (the magnitude,
+    # shifted to 0 and scaled by its peak), in place; an all-zero mix (every
+    # weight 0) stays black
+    np.abs(mixed, out=mixed)
+    mixed -= mixed.min(axis=image_axes, keepdims=True)
+    peak = mixed.max(axis=image_axes, keepdims=True)
+    np.divide(mixed, peak, out=mixed, where=peak > 0)
+    mixed *= 255
+    return mixed.astype(np.uint8)
+
+
+class MixCancelled(Exception):
+    # Raised from a progress callback to abandon a mix that is no longer wanted
+    pass
+
+
+def validate_selection(category, selected_components_names):
+    # Return a warning message if the selection cannot be mixed, else None
+    if all(item == selected_components_names[0] for item in selected_components_names):
+        return 'The selected components should not be all the same.'
+    allowed = CATEGORY_COMPONENTS[category]
+    if any(item not in allowed for item in selected_components_names):
+        return 'The selected components should all be the same category.'
+    return None
+
+
+class Mixer:
+    # Incremental updates between full rebuilds of the running sums, so
+    # rounding errors of the deltas cannot pile up
+    REBUILD_EVERY = 256
+
+    def __init__(self, backend=None):
+        self.weights = [0.0, 0.0, 0.0, 0.0]
+        self.selected_components = [
+            [], [], [], []]
+        # Whether each component keeps the symmetry of a real image's spectrum
+        # (true unless a non-symmetric region mask was applied to it)
+        self.symmetric = [True, True, True, True]
+        # Bumped on every set_component, since component buffers can be
+        # rewritten in place and identity alone does not reveal a change
+        self.versions = [0, 0, 0, 0]
+        self.backend = fft_backend if backend is None else backend
+
+        # Running weighted sums of the two component kinds, the terms they
+        # currently hold as {index: (sum, weight, version)}, and a scratch buffer
+        self.sums = None
+        self.terms = {}
+        self.sum_names = None
+        self.scratch = None
+        self.updates = 0
+
+    def set_weights(self, index, value):
+        # Set weight for a specific index
+        self.weights[index] = value / 10.0
+
+    def set_component(self, index, component, symmetric=True):
+        # Set component for a specific index
+        self.selected_components[index] = component
+        self.symmetric[index] = symmetric
+        self.versions[index] += 1
+
+    @property
+    def hermitian(self):
+        # The mixed spectrum is Hermitian, so its inverse is real, when all
+        # components are; the real inverse FFT is only valid then
+        return all(self.symmetric)
+
+    def component_shape(self):
+        # Shape of the loaded components, or None before any is set
+        for component in self.selected_components:
+            if isinstance(component, np.ndarray):
+                return component.shape
+        return None
+
+    def snapshot(self):
+        # Independent copy of the weights and component references, so a mix can
+        # run in the background while the sliders keep changing this mixer
+        mixer = Mixer(self.backend)
+        mixer.weights = list(self.weights)
+        mixer.selected_components = list(self.selected_components)
+        mixer.symmetric = list(self.symmetric)
+        mixer.versions = list(self.versions)
+        return mixer
+
+    def adopt(self, other):
+        # Take over the state of another mixer (usually a snapshot) while
+        # keeping this mixer's running sums for incremental updates
+        self.weights = list(other.weights)
+        self.selected_components = list(other.selected_components)
+        self.symmetric = list(other.symmetric)
+        self.versions = list(other.versions)
+        self.backend = other.backend
+
+    def mixed_spectrum(self, comp1, comp2, category):
+        # Mixed spectrum of the summed components, and whether it is
+        # Hermitian: then only the half of it irfft2 reads is combined
+        hermitian = self.backend.real and self.hermitian
+        if hermitian:
+            index = (Ellipsis,) + half_index(comp1.shape[-2:])
+            comp1, comp2 = comp1[index], comp2[index]
+        if category == 'Magnitude & Phase':
+            return comp1 * np.exp(1j * comp2), hermitian
+        return comp1 + 1j * comp2, hermitian
+
+    def reconstruct(self, mixed_complex, shape, hermitian, image_axes=None):
+        # uint8 image of a mixed spectrum of (height, width) shape, or of a
+        # stack of them with image_axes the axes of one image (default all)
+        if hermitian:
+            mixed_image = self.backend.inverse_half(mixed_complex, shape)
+        else:
+            mixed_image = np.abs(self.backend.inverse(mixed_complex))
+        if image_axes is None:
+            image_axes = tuple(range(mixed_image.ndim))
+        return normalize(mixed_image, image_axes)
+
+    def mix_and_reconstruct(self, comp1, comp2, category, progress=None):
+        mixed_complex, hermitian = self.mixed_spectrum(comp1, comp2, category)
+        if progress:
+            progress(0.6)
+        mixed_image = self.reconstruct(mixed_complex, comp1.shape[-2:], hermitian)
+        if mixed_image.ndim == 3:
+            # Back to the (height, width, channels) layout of images
+            mixed_image = np.ascontiguousarray(mixed_image.transpose(1, 2, 0))
+        if progress:
+            progress(1.0)
+        return mixed_image
+
+    def mix_images(self, category, selected_components_names, progress=None,
+                   preview_shape=None):
+        # progress, if given, is called with the completed fraction between stages.
+        # With preview_shape only the central (low frequency) block of that size
+        # is inverted, giving a quick low-resolution version of the result.
+        s1, s2 = CATEGORY_COMPONENTS[category]
+        with timing.stage('create_mixed_components'):
+            comp1, comp2 = self.create_mixed_components(
+                s1, s2, selected_components_names, progress)
+        if preview_shape is not None:
+            comp1 = center_crop(comp1, preview_shape)
+            comp2 = center_crop(comp2, preview_shape)
+        with timing.stage('mix_and_reconstruct'):
+            mixed_image = self.mix_and_reconstruct(comp1, comp2, category, progress)
+        return mixed_image
+
+    def add_scaled(self, total, weight, component):
+        # total += weight * component, through the scratch buffer so no
+        # temporary array is allocated
+        if weight == 0:
+            return
+        np.multiply(component, weight, out=self.scratch)
+        np.add(total, self.scratch, out=total)
+
+    def create_mixed_components(self, s1, s2, selected_components_names, progress=None):
+        # The weighted sums persist between mixes: a weight change only adds
+        # (w_new - w_old) * component to its sum, while a new component or
+        # selection rebuilds the sum it belongs to
+        count = len(selected_components_names)
+        components = self.selected_components[:count]
+        # Slots without an image yet hold an empty list and are left out
+        loaded = [index for index in range(count) if isinstance(components[index], np.ndarray)]
+        shape = components[loaded[0]].shape
+        dtype = np.result_type(*[components[index] for index in loaded])
+        if self.sums is None or self.sums[0].shape != shape or self.sums[0].dtype != dtype:
+            self.sums = [np.zeros(shape, dtype), np.zeros(shape, dtype)]
+            self.scratch = np.empty(shape, dtype)
+            self.terms = {}
+            self.sum_names = None
+
+        targets = {}
+        for index in loaded:
+            total = 0 if selected_components_names[index] == s1 else 1
+            targets[index] = (total, self.weights[index], self.versions[index])
+
+        stale = set()
+        if self.sum_names != (s1, s2) or self.updates >= self.REBUILD_EVERY:
+            stale = {0, 1}
+        for index in set(targets) | set(self.terms):
+            target, term = targets.get(index), self.terms.get(index)
+            if target is None or term is None or target[0] != term[0] or target[2] != term[2]:
+                stale.update(item[0] for item in (target, term) if item is not None)
+
+        steps = len(stale) + sum(1 for index, target in targets.items()
+                                 if target[0] not in stale and target[1] != self.terms[index][1])
+        done = 0
+        for total in sorted(stale):
+            # Rebuild in place; terms always describe exactly what a sum holds
+            for index in [index for index, term in self.terms.items() if term[0] == total]:
+                del self.terms[index]
+            self.sums[total].fill(0)
+            for index, target in targets.items():
+                if target[0] == total:
+                    self.add_scaled(self.sums[total], target[1], components[index])
+                    self.terms[index] = target
+            done += 1
+            if progress:
+                progress(0.5 * done / steps)
+        if stale == {0, 1}:
+            self.sum_names = (s1, s2)
+            self.updates = 0
+
+        for index, target in targets.items():
+            term = self.terms[index]
+            if target[0] in stale or target[1] == term[1]:
+                continue
+            self.add_scaled(self.sums[target[0]], target[1] - term[1], components[index])
+            self.terms[index] = target
+            self.updates += 1
+            done += 1
+            if progress:
+                progress(0.5 * done / steps)
+        return self.sums[0], self.sums[1]
@@ -0,0 +1,180 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Pluggable FFT engines for the mixer. Input images are real, so by default the
+# forward transform runs as a real FFT (rfft2) and the full shifted spectrum is
+# filled in from Hermitian symmetry; the inverse uses irfft2 whenever the mixed
+# spectrum is known to be Hermitian. "single" precision keeps everything in
+# float32/complex64. Transforms run over the last two axes, so stacks of
+# channels or images go through one batched call.
+
+PRECISIONS = {
+    'double': (np.float64, np.complex128),
+    'single': (np.float32, np.complex64),
+}
+
+
+@lru_cache(maxsize=16)
+def half_index(shape):
+    # Index into a shifted spectrum selecting the rfft2 half (non-negative
+    # frequencies along the last axis) in unshifted order
+    height, width = shape
+    rows = (np.arange(height) + height // 2) % height
+    cols = (np.arange(width // 2 + 1) + width // 2) % width
+    return np.ix_(rows, cols)
+
+
+@lru_cache(maxsize=16)
+def conjugate_index(shape):
+    # Index mapping every entry of a shifted spectrum to its conjugate-symmetric
+    # partner, so a Hermitian spectrum x satisfies x == conj(x[conjugate_index])
+    height, width = shape
+    rows = (2 * (height // 2) - np.arange(height)) % height
+    cols = (2 * (width // 2) - np.arange(width)) % width
+    return np.ix_(rows, cols)
+
+
+class FFTBackend:
+    name = None
+
+    def __init__(self, precision='double', real=True, workers=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision: {precision}')
+        self.precision = precision
+        self.real_dtype, self.complex_dtype = PRECISIONS[precision]
+        self.real = real
+        self.workers = workers
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.precision!r}, real={self.real}, workers={self.workers})'
+
+    @property
+    def key(self):
+        # Spectra from any engine with the same precision are interchangeable
+        return np.dtype(self.complex_dtype).str
+
+    def _fft2(self, array):
+        raise NotImplementedError
+
+    def _ifft2(self, array):
+        raise NotImplementedError
+
+    def _rfft2(self, array):
+        raise NotImplementedError
+
+    def _irfft2(self, array, shape):
+        raise NotImplementedError
+
+    def forward(self, image):
+        # Shifted full spectrum of a real image (or stack of images)
+        image = np.asarray(image, dtype=self.real_dtype)
+        if not self.real:
+            spectrum = self._fft2(image)
+            return np.fft.fftshift(spectrum, axes=(-2, -1)).astype(self.complex_dtype, copy=False)
+
+        height, width = image.shape[-2:]
+        half = self._rfft2(image)
+        spectrum = np.empty(image.shape, dtype=self.complex_dtype)
+        spectrum[..., :width // 2 + 1] = half
+        # X[k1, k2] = conj(X[-k1, -k2]) fills the negative frequencies
+        rows = -np.arange(height) % height
+        cols = width - np.arange(width // 2 + 1, width)
+        np.conjugate(half[..., rows[:, None], cols[None, :]],
+                     out=spectrum[..., width // 2 + 1:])
+        return np.fft.fftshift(spectrum, axes=(-2, -1))
+
+    def inverse(self, shifted_spectrum, hermitian=False):
+        # Inverse of a shifted spectrum; a real result when it is Hermitian
+        shape = shifted_spectrum.shape[-2:]
+        if self.real and hermitian:
+            return self.inverse_half(shifted_spectrum[(Ellipsis,) + half_index(shape)], shape)
+        spectrum = np.fft.ifftshift(shifted_spectrum, axes=(-2, -1))
+        return self._ifft2(spectrum.astype(self.complex_dtype, copy=False))
+
+    def inverse_half(self, half, shape):
+        # Real image from the rfft2 half taken with half_index
+        return self._irfft2(half.astype(self.complex_dtype, copy=False), tuple(shape[-2:]))
+
+
+class NumpyFFT(FFTBackend):
+    name = 'numpy'
+
+    def _fft2(self, array):
+        return np.fft.fft2(array)
+
+    def _ifft2(self, array):
+        return np.fft.ifft2(array)
+
+    def _rfft2(self, array):
+        return np.fft.rfft2(array)
+
+    def _irfft2(self, array, shape):
+        return np.fft.irfft2(array, s=shape)
+
+
+class ScipyFFT(FFTBackend):
+    name = 'scipy'
+
+    def __init__(self, precision='double', real=True, workers=None):
+        import scipy.fft
+        super(ScipyFFT, self).__init__(precision, real, -1 if workers is None else workers)
+        self.fft = scipy.fft
+
+    def _fft2(self, array):
+        return self.fft.fft2(array, workers=self.workers)
+
+    def _ifft2(self, array):
+        return self.fft.ifft2(array, workers=self.workers)
+
+    def _rfft2(self, array):
+        return self.fft.rfft2(array, workers=self.workers)
+
+    def _irfft2(self, array, shape):
+        return self.fft.irfft2(array, s=shape, workers=self.workers)
+
+
+class PyFFTW(FFTBackend):
+    name = 'pyfftw'
+
+    def __init__(self, precision='double', real=True, workers=None):
+        import os
+        import pyfftw
+        import pyfftw.interfaces.numpy_fft
+        super(PyFFTW, self).__init__(precision, real, workers or os.cpu_count())
+        # Keep the FFTW plans of recent shapes around between mixes
+        pyfftw.interfaces.cache.enable()
+        self.fft = pyfftw.interfaces.numpy_fft
+
+    def _fft2(self, array):
+        return self.fft.fft2(array, threads=self.workers)
+
+    def _ifft2(self, array):
+        return self.fft.ifft2(array, threads=self.workers)
+
+    def _rfft2(self, array):
+        return self.fft.rfft2(array, threads=self.workers)
+
+    def _irfft2(self, array, shape):
+        return self.fft.irfft2(array, s=shape, threads=self.workers)
+
+
+FFT_BACKENDS = {backend.name: backend for backend in (NumpyFFT, ScipyFFT, PyFFTW)}
+
+
+def get_backend(name='numpy', precision='double', real=True, workers=None):
+    if name not in FFT_BACKENDS:
+        raise ValueError(f'Unknown FFT backend: {name}')
+    return FFT_BACKENDS[name](precision, real, workers)
+
+
+def available_backends():
+    # Names of the engines whose library can be imported here
+    names = []
+    for name in FFT_BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
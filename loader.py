@@ -0,0 +1,220 @@
+import os
+import shutil
+import struct
+import tempfile
+import warnings
+import weakref
+from os import path
+
+import cv2
+import numpy as np
+
+# Loading of (possibly very large) source images. The full-resolution original
+# is decoded once into memory-mapped scratch storage, with a pyramid of
+# half-size levels next to it; working copies and display thumbnails are
+# resized from the nearest pyramid level instead of from the original, so
+# only the working-resolution arrays stay resident in memory.
+
+# Color modes, with the OpenCV conversions from and back to BGR. Color images
+# are mixed channel by channel, all channels in one stacked array.
+COLOR_MODES = ('gray', 'rgb', 'ycbcr')
+COLOR_CONVERSIONS = {
+    'rgb': (cv2.COLOR_BGR2RGB, cv2.COLOR_RGB2BGR),
+    'ycbcr': (cv2.COLOR_BGR2YCrCb, cv2.COLOR_YCrCb2BGR),
+}
+
+# cv2 flags decoding at 1/2, 1/4 and 1/8 of the resolution; only JPEG is
+# decoded at that size, other formats are fully decoded and then resized
+REDUCED_FLAGS = {
+    'gray': {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+             4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+    'color': {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+              4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+}
+
+# Image slots sharing the memory ceiling, and the bytes each working pixel
+# (per channel) costs: the uint8 image, its complex spectrum, a derived
+# component, the region buffer and the mixer sums
+SLOTS = 4
+WORKING_BYTES_PER_PIXEL = 64
+
+# Rows converted or downsampled per step, and the smallest pyramid level side
+TILE_ROWS = 512
+MIN_LEVEL_SIDE = 256
+
+
+def image_size(image_path):
+    # (width, height) from the PNG, JPEG or BMP header without decoding, or
+    # None for other or unreadable files
+    try:
+        with open(image_path, 'rb') as image_file:
+            head = image_file.read(26)
+            if head[:8] == b'\x89PNG\r\n\x1a\n':
+                return struct.unpack('>II', head[16:24])
+            if head[:2] == b'BM':
+                width, height = struct.unpack('<ii', head[18:26])
+                return width, abs(height)
+            if head[:2] != b'\xff\xd8':
+                return None
+            image_file.seek(2)
+            while True:
+                marker = image_file.read(2)
+                while marker[:1] == b'\xff' and marker[1:] == b'\xff':
+                    marker = b'\xff' + image_file.read(1)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    return None
+                if marker[1] in (0x01, *range(0xd0, 0xda)):
+                    continue
+                length, = struct.unpack('>H', image_file.read(2))
+                # Start-of-frame markers carry the size; C4, C8 and CC do not
+                if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>xHH', image_file.read(5))
+                    return width, height
+                image_file.seek(length - 2, 1)
+    except (OSError, struct.error):
+        return None
+
+
+def is_jpeg(image_path):
+    try:
+        with open(image_path, 'rb') as image_file:
+            return image_file.read(2) == b'\xff\xd8'
+    except OSError:
+        return False
+
+
+def remove_files(file_paths):
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+
+def fit_size(shape, max_width, max_height):
+    # Largest (width, height) within the bounds keeping the aspect of shape
+    height, width = shape[:2]
+    scale = min(max_width / width, max_height / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class SourceImage:
+    def __init__(self, levels, image_path, color_mode):
+        # levels[0] is the original (decoded at a reduced resolution when the
+        # memory ceiling required it), each next level half the size
+        self.levels = levels
+        self.image_path = image_path
+        self.color_mode = color_mode
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def level_for(self, width, height):
+        # Smallest pyramid level still at least (width, height)
+        for level in reversed(self.levels):
+            if level.shape[1] >= width and level.shape[0] >= height:
+                return level
+        return self.levels[0]
+
+    def resize(self, target_size):
+        # In-memory copy at (width, height), resized from the nearest level
+        level = self.level_for(*target_size)
+        if level.shape[1::-1] == tuple(target_size):
+            return np.array(level)
+        return cv2.resize(level, tuple(target_size), interpolation=cv2.INTER_AREA)
+
+    def working_image(self, max_pixels):
+        # Copy of at most max_pixels pixels, the resolution mixing runs at
+        height, width = self.shape[:2]
+        scale = min(1.0, (max_pixels / (width * height)) ** 0.5)
+        return self.resize((max(1, int(width * scale)), max(1, int(height * scale))))
+
+
+class ImageStore:
+    def __init__(self, memory_limit=2 << 30, scratch_dir=None):
+        # memory_limit bounds the resident working set: a decode never takes
+        # more than half of it and the working copies of all slots share it
+        self.memory_limit = memory_limit
+        self.scratch_dir = tempfile.mkdtemp(prefix='imageharmonize-', dir=scratch_dir)
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.scratch_dir, True)
+        self.sources = weakref.WeakValueDictionary()
+        self.counter = 0
+
+    def close(self):
+        self.finalizer()
+
+    def max_working_pixels(self, channels=1):
+        return max(1, self.memory_limit // (SLOTS * WORKING_BYTES_PER_PIXEL * channels))
+
+    def scratch_array(self, shape):
+        self.counter += 1
+        file_path = path.join(self.scratch_dir, f'{self.counter}.raw')
+        return np.memmap(file_path, dtype=np.uint8, mode='w+', shape=shape)
+
+    def reduction_for(self, image_path, color_mode):
+        size = image_size(image_path)
+        if size is None:
+            return 1
+        channels = 1 if color_mode == 'gray' else 3
+        if size[0] * size[1] * channels <= self.memory_limit // 2:
+            return 1
+        if not is_jpeg(image_path):
+            # A reduced flag would not lower the peak of the full decode, so
+            # keep the full resolution (the working copy is capped anyway)
+            warnings.warn(f'{image_path} is decoded at full size, over half the memory ceiling; '
+                          'only JPEG files can be decoded at a reduced resolution.',
+                          RuntimeWarning, stacklevel=3)
+            return 1
+        for reduction in (2, 4, 8):
+            if size[0] * size[1] * channels // reduction ** 2 <= self.memory_limit // 2:
+                return reduction
+        return 8
+
+    def load(self, image_path, color_mode='gray'):
+        # Source image for a file, shared while it is in use
+        try:
+            key = (path.abspath(image_path), path.getmtime(image_path), color_mode)
+        except OSError:
+            return None
+        source = self.sources.get(key)
+        if source is not None:
+            return source
+
+        reduction = self.reduction_for(image_path, color_mode)
+        flags = REDUCED_FLAGS['gray' if color_mode == 'gray' else 'color'][reduction]
+        decoded = cv2.imread(image_path, flags)
+        if decoded is None:
+            return None
+        # Convert into scratch storage tile by tile, then drop the decoded copy
+        original = self.scratch_array(decoded.shape)
+        for row in range(0, decoded.shape[0], TILE_ROWS):
+            tile = decoded[row:row + TILE_ROWS]
+            if color_mode != 'gray':
+                tile = cv2.cvtColor(tile, COLOR_CONVERSIONS[color_mode][0])
+            original[row:row + TILE_ROWS] = tile
+        del decoded
+
+        levels = [original]
+        while min(levels[-1].shape[:2]) >= 2 * MIN_LEVEL_SIDE:
+            levels.append(self.half_level(levels[-1]))
+        source = SourceImage(levels, image_path, color_mode)
+        # The level files go with the source, not only with the whole store
+        weakref.finalize(source, remove_files, [level.filename for level in levels])
+        self.sources[key] = source
+        return source
+
+    def half_level(self, level):
+        # Next pyramid level, averaged down in bands of TILE_ROWS output rows
+        height, width = level.shape[0] // 2, level.shape[1] // 2
+        half = self.scratch_array((height, width) + level.shape[2:])
+        for row in range(0, height, TILE_ROWS):
+            rows = min(TILE_ROWS, height - row)
+            band = level[2 * row:2 * (row + rows), :2 * width]
+            half[row:row + rows] = cv2.resize(np.asarray(band), (width, rows),
+                                              interpolation=cv2.INTER_AREA)
+        return half
+
+
+# Store used when an ImageProcessor is not given one
+image_store = ImageStore()
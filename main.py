@@ -6,94 +6,125 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.uic import loadUiType
 from PyQt5 import uic
+import logging
 import sys
+import threading
+import time
+
+from engine import (ImageProcessor, MixCancelled, Mixer, compute_fourier_transforms, preview_shape,
+                    to_rgb, validate_selection)
+from loader import fit_size
+from masks import (REGION_EDGES, REGION_SHAPES, RING_WIDTH, apply_region, region_is_symmetric,
+                   region_rect, shade_region)
+from render_graph import Node, Source
+from session import Session, is_session, load_session, save_session
+import timing
 
 FORM_CLASS, _ = loadUiType(
     path.join(path.dirname(__file__), "fourier_transform_mixer.ui"))
 
+# Time budget of one preview mix while dragging, and how long a slider has to
+# rest before the full-resolution mix is computed
+PREVIEW_FRAME_TIME = 1 / 30
+PREVIEW_IDLE_MS = 250
 
-class ImageProcessor:
-    def __init__(self, image_path):
-        self.image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        self.fourier_components = {'FT Magnitude': 0,
-                                   'FT Phase': 0, 'FT Real': 0, 'FT Imaginary': 0}
+# Color mode picker entries and the engine modes they select
+COLOR_MODE_NAMES = {'Gray': 'gray', 'RGB': 'rgb', 'YCbCr': 'ycbcr'}
 
-    def resize_image(self, target_size):
-        self.image = cv2.resize(self.image, target_size)
+logger = logging.getLogger('imageharmonize')
 
-    def compute_fourier_transform(self):
-        # Compute the 2D Fourier Transform
-        fourier_transform = np.fft.fft2(self.image)
 
-        # Shift zero frequency components to the center
-        fourier_transform_shifted = np.fft.fftshift(fourier_transform)
+def array_to_qimage(array):
+    # Wrap a uint8 array, (height, width) gray or (height, width, 3) RGB, as a
+    # QImage over the same memory. The array is kept on the image so the buffer
+    # outlives every pixmap made from it.
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    image_format = QImage.Format_RGB888 if array.ndim == 3 else QImage.Format_Grayscale8
+    q_image = QImage(array.data, array.shape[1], array.shape[0],
+                     array.strides[0], image_format)
+    q_image.ndarray = array
+    return q_image
 
-        # Compute the magnitude and phase
-        self.fourier_components['FT Magnitude'] = np.abs(
-            fourier_transform_shifted)
-        self.fourier_components['FT Phase'] = np.angle(
-            fourier_transform_shifted)
 
-        # Compute the real and imaginary parts
-        self.fourier_components['FT Real'] = np.real(fourier_transform_shifted)
-        self.fourier_components['FT Imaginary'] = np.imag(
-            fourier_transform_shifted)
+def qimage_to_array(q_image):
+    # Copy of a Grayscale8 or RGB888 QImage, e.g. after painting on it
+    width, height = q_image.width(), q_image.height()
+    channels = 3 if q_image.format() == QImage.Format_RGB888 else 1
+    bits = q_image.constBits()
+    bits.setsize(q_image.sizeInBytes())
+    rows = np.frombuffer(bits, np.uint8).reshape(height, q_image.bytesPerLine())
+    array = rows[:, :width * channels].reshape((height, width, channels)[:2 + (channels > 1)])
+    return array.copy()
 
-    def get_component(self, component_type):
-        # Get the specified Fourier transform component (Magnitude, Phase, Real, Imaginary)
-        return self.fourier_components[f'{component_type}']
 
+def brightness_contrast_lut(brightness, contrast):
+    # Table mapping every uint8 value through the brightness/contrast curve
+    values = (np.arange(256, dtype=np.float32) - 128) * contrast + 128 + brightness * 128
+    return np.clip(values, 0, 255).astype(np.uint8)
 
-class ImageViewer:
-    def __init__(self, label_widget, component_widget=None, combobox_widget=None):
+
+class AdjustableDisplay:
+    # A label showing a uint8 image whose brightness and contrast follow mouse
+    # drags. The image is kept at the label's size and adjusted through a
+    # lookup table into one reused buffer, so a drag costs the same whatever
+    # the size of the source image.
+    def __init__(self, label_widget):
         self.label_widget = label_widget
-        self.component_widget = component_widget
-        self.combobox_widget = combobox_widget
-        self.image_processor = None
-        self.component_pixmap = None
-        self.displayed_component = 'FT Magnitude'
         self.brightness_factor = 0.5
         self.contrast_factor = 0.7
         self.dragging = False
         self.last_pos = QPoint()
+        self.adjusted_once = False
+        self.display = None
+        self.adjusted = None
+        self.q_image = None
+        self.pixmap = QPixmap()
+
+    def show(self, image, keep_adjustment=False):
+        # Show an image fitted to the label, unadjusted unless keep_adjustment
+        # asks to carry over the brightness/contrast of earlier drags
+        size = self.label_widget.size()
+        fitted = fit_size(image.shape, size.width(), size.height())
+        if fitted != image.shape[1::-1]:
+            image = cv2.resize(image, fitted, interpolation=cv2.INTER_AREA)
+        self.display = np.ascontiguousarray(image)
+        self.adjusted = np.empty_like(self.display)
+        self.q_image = array_to_qimage(self.adjusted)
+        if keep_adjustment and self.adjusted_once:
+            self.apply_brightness_contrast(self.brightness_factor, self.contrast_factor)
+        else:
+            self.pixmap = QPixmap.fromImage(array_to_qimage(self.display))
+            self.set_pixmap()
+
+    def set_pixmap(self):
+        # Only images smaller than the label still need scaling here
+        size = self.label_widget.size()
+        if self.pixmap.width() < size.width() and self.pixmap.height() < size.height():
+            self.label_widget.setPixmap(self.pixmap.scaled(size, Qt.KeepAspectRatio))
+        else:
+            self.label_widget.setPixmap(self.pixmap)
 
     def adjust_brightness(self, delta):
-        self.brightness_factor += delta/2
-        # Ensure it's within bounds
-        self.brightness_factor = max(0.1, min(2.0, self.brightness_factor))
-        self.apply_brightness_contrast(
-            self.brightness_factor, self.contrast_factor)
+        self.adjust(delta, 0)
 
     def adjust_contrast(self, delta):
-        self.contrast_factor += delta/2
-        # Ensure it's within bounds
+        self.adjust(0, delta)
+
+    def adjust(self, brightness_delta, contrast_delta):
+        self.brightness_factor += brightness_delta/2
+        self.contrast_factor += contrast_delta/2
+        # Ensure they're within bounds
+        self.brightness_factor = max(0.1, min(2.0, self.brightness_factor))
         self.contrast_factor = max(0.1, min(2.0, self.contrast_factor))
-        self.apply_brightness_contrast(
-            self.brightness_factor, self.contrast_factor)
+        self.adjusted_once = True
+        self.apply_brightness_contrast(self.brightness_factor, self.contrast_factor)
 
     def apply_brightness_contrast(self, brightness, contrast):
-        if self.image_processor is not None:
-            q_image = QImage(self.image_processor.image.data,
-                             self.image_processor.image.shape[1], self.image_processor.image.shape[0], QImage.Format_Grayscale8)
-
-            # Create a copy to avoid modifying the original image
-            adjusted_image = q_image.copy()
-            ptr = adjusted_image.bits()
-            ptr.setsize(adjusted_image.byteCount())
-            arr = np.frombuffer(ptr, np.uint8).reshape(
-                (adjusted_image.height(), adjusted_image.width()))
-
-            # Applying brightness and contrast adjustments directly to pixel values
-            arr = np.clip((arr - 128) * contrast + 128 +
-                          brightness * 128, 0, 255).astype(np.uint8)
-
-            # Update QImage with the modified pixel values
-            q_image = QImage(
-                arr, arr.shape[1], arr.shape[0], arr.shape[1], QImage.Format_Grayscale8)
-
-            pixmap = QPixmap.fromImage(q_image)
-            self.label_widget.setPixmap(pixmap.scaled(
-                self.label_widget.size(), Qt.KeepAspectRatio))
+        if self.display is not None:
+            cv2.LUT(self.display, brightness_contrast_lut(brightness, contrast),
+                    dst=self.adjusted)
+            self.pixmap.convertFromImage(self.q_image)
+            self.set_pixmap()
 
     def mousePressEvent(self, event):
         if event.buttons() == Qt.LeftButton:
@@ -104,120 +135,243 @@ class ImageViewer:
         if self.dragging:
             delta_x = (event.pos().x() - self.last_pos.x())/5
             delta_y = (event.pos().y() - self.last_pos.y())/5
-            brightness_step = 0.01  # Adjust this step as needed
-            # Adjust brightness by dragging left and right
-            self.adjust_brightness(delta_x * brightness_step)
-            contrast_step = 0.01  # Adjust this step as needed
-            # Adjust contrast by dragging up and down
-            self.adjust_contrast(delta_y * contrast_step)
+            # Brightness follows left/right drags, contrast up/down ones
+            step = 0.01
+            self.adjust(delta_x * step, delta_y * step)
             self.last_pos = event.pos()
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton:
             self.dragging = False
 
-    def apply_draw_rect_shade(self, value,out):
-        if self.image_processor:
-            component = self.image_processor.get_component(self.displayed_component)
-            component_copy = np.copy(component)
-            if value != 0:
-                q_image = self.show_fourier_component_image(component_copy)
-                self.component_pixmap = QPixmap.fromImage(q_image)
-                painter = QPainter()
-                painter.begin(q_image)
-                painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
-                # Calculate rectangle coordinates for the center
-                image_width = q_image.width()
-                image_height = q_image.height()
-            
-                rect_width = int(image_width * value/10)
-                rect_height = int(image_height * value/10)
 
-                # Make sure rect_x, rect_y, rect_width, rect_height are integers
-                rect_x = int((image_width - rect_width)/2)
-                rect_y = int((image_height - rect_height)/2)
+class MixWorker(QThread):
+    # Runs mixes off the GUI thread. Requests are coalesced: only the newest one
+    # is computed, and a running mix is abandoned as soon as a newer one arrives.
+    progress = pyqtSignal(int)
+    # generation, mixed image, seconds taken, whether it is a preview
+    mixed = pyqtSignal(int, object, float, bool)
+    # generation, error message of a mix that raised
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, parent=None):
+        super(MixWorker, self).__init__(parent)
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.stopping = False
+        # Owned by the worker thread; keeps the running sums between requests
+        self.mixer = Mixer()
+
+    def submit(self, mixer, category, selected_components, preview_scale=None):
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, mixer.snapshot(),
+                            category, selected_components, preview_scale)
+            self.condition.notify()
+        return self.generation
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.generation += 1
+            self.condition.notify()
+        self.wait()
+
+    def is_current(self, generation):
+        return generation == self.generation and not self.stopping
+
+    def report(self, generation, fraction, preview):
+        if not self.is_current(generation):
+            raise MixCancelled()
+        if not preview:
+            self.progress.emit(int(fraction * 100))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                generation, mixer, category, selected_components, preview_scale = self.pending
+                self.pending = None
+            self.mixer.adopt(mixer)
+            preview = preview_scale is not None
+            started = time.perf_counter()
+            try:
+                mixed_image = self.mixer.mix_images(
+                    category, selected_components,
+                    lambda fraction: self.report(generation, fraction, preview),
+                    preview_shape(mixer.component_shape(), preview_scale)
+                    if preview else None)
+            except MixCancelled:
+                timing.flush(f'mix {generation} (cancelled)')
+                continue
+            except Exception as error:
+                # An exception leaving run() would abort the whole application
+                logger.exception('Mix %d failed', generation)
+                timing.flush(f'mix {generation} (failed)')
+                self.failed.emit(generation, str(error))
+                continue
+            timing.flush(f"mix {generation}{' (preview)' if preview else ''}")
+            if self.is_current(generation):
+                self.mixed.emit(generation, mixed_image,
+                                time.perf_counter() - started, preview)
+
+
+class ImageViewer:
+    def __init__(self, label_widget, component_widget=None, combobox_widget=None, region=None):
+        self.label_widget = label_widget
+        self.component_widget = component_widget
+        self.combobox_widget = combobox_widget
+        self.masked_component = None
+        # The image and its FT component are both adjustable by dragging
+        self.image_display = AdjustableDisplay(label_widget)
+        self.component_display = None
+        if component_widget is not None:
+            self.component_display = AdjustableDisplay(component_widget)
+
+        # Render graph of this viewer: processor -> spectrum -> component ->
+        # masked component for the mixer, and component -> normalized display
+        # -> shaded display. `region` holds the (value, out, shape, edge)
+        # settings shared by all viewers.
+        self.processor_input = Source()
+        self.component_name = Source('FT Magnitude')
+        self.region = Source((0, True, 'rectangle', 'hard')) if region is None else region
+        self.spectrum = Node(lambda processor: None if processor is None else processor.spectrum,
+                             self.processor_input)
+        self.component = Node(self.compute_component,
+                              self.processor_input, self.spectrum, self.component_name)
+        self.masked = Node(self.mask_component, self.component, self.region)
+        self.image_output = Node(lambda processor: self.show_image(), self.processor_input)
+        self.normalized = Node(self.fit_component, self.component)
+        self.component_output = Node(self.show_component, self.normalized, self.region)
+
+    @property
+    def image_processor(self):
+        return self.processor_input.value
+
+    @image_processor.setter
+    def image_processor(self, processor):
+        self.processor_input.set(processor)
+
+    @property
+    def displayed_component(self):
+        return self.component_name.value
+
+    @displayed_component.setter
+    def displayed_component(self, name):
+        self.component_name.set(name)
+
+    def render(self):
+        # Bring the displays up to date with the graph
+        self.image_output.refresh()
+        if self.component_display is not None:
+            self.component_output.refresh()
 
-                # Set the pixels inside the rectangle to True in the mask
-                # Draw a rectangle on the image at the center
-                pen = QPen(Qt.red)
-                painter.setPen(pen)
+    def apply_brightness_contrast(self, brightness, contrast):
+        self.image_display.apply_brightness_contrast(brightness, contrast)
+
+    def mousePressEvent(self, event):
+        self.image_display.mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        self.image_display.mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        self.image_display.mouseReleaseEvent(event)
+
+    def compute_component(self, processor, spectrum, name):
+        if processor is None or spectrum is None:
+            return None
+        return processor.get_component(name)
+
+    def mask_component(self, component, region):
+        # (masked component, whether it stays Hermitian) for the mixer
+        if component is None:
+            return None
+        value, out, region_shape, edge = region
+        # Masking reuses this viewer's buffer instead of copying the component
+        with timing.stage('mask'):
+            masked_component = apply_region(
+                component, value, out, region_shape, edge, buffer=self.masked_component)
+        if value != 0:
+            self.masked_component = masked_component
+        return masked_component, region_is_symmetric(
+            component.shape[-2:], value, out, region_shape, edge)
+
+    def fit_component(self, component):
+        # Normalized component at the label's size; only redone when the
+        # component itself changes, not when the region does
+        if component is None:
+            return None
+        with timing.stage('normalize'):
+            display = self.normalize_component(component)
+            size = self.component_widget.size()
+            fitted = fit_size(display.shape, size.width(), size.height())
+            if fitted != display.shape[1::-1]:
+                display = cv2.resize(display, fitted, interpolation=cv2.INTER_AREA)
+        return display
+
+    def show_component(self, normalized, region):
+        if normalized is None:
+            return
+        with timing.stage('shade'):
+            self.shade_component(normalized, region)
+
+    def shade_component(self, normalized, region):
+        value, out, region_shape, edge = region
+        display = shade_region(normalized.copy(), value, out, region_shape, edge)
+        q_image = self.create_q_image(display)
+        if value != 0:
+            painter = QPainter()
+            painter.begin(q_image)
+            painter.setPen(QPen(Qt.red))
+            rect_x, rect_y, rect_width, rect_height = region_rect(
+                display.shape[:2], value)
+            if region_shape == 'rectangle':
                 painter.drawRect(rect_x, rect_y, rect_width, rect_height)
-                if out:
-                    # Create a QPainterPath to define the region outside the rectangle
-                    path = QPainterPath()
-                    path.addRect(0, 0, q_image.width(), q_image.height())
-
-                    # Subtract the rectangle path from the outer region path
-                    rect_path = QPainterPath()
-                    rect_path.addRect(rect_x, rect_y, rect_width, rect_height)
-                    path -= rect_path
-
-                    # Shade the region outside the rectangle
-                    shade_color = QColor(0, 0, 0, 100)  # Semi-transparent black
-                    painter.fillPath(path, shade_color)
-                    for i in range(rect_x, rect_x + rect_width):
-                        for j in range(rect_y, rect_y + rect_height):
-                            component_copy[j][i] = 0
-                else :
-                    shade_color = QColor(0, 0, 0, 100)  # Semi-transparent black
-                    painter.fillRect(rect_x, rect_y, rect_width, rect_height, shade_color)
-                    
-                    # Zero values outside the rectangle in the component array
-        
-                    for i in range(image_width):
-                        for j in range(image_height):
-                            if i < rect_x or i >= rect_x + rect_width \
-                                or j < rect_y or j >= rect_y + rect_height:
-                                component_copy[j][i] = 0
-                painter.end()
-                self.component_pixmap = QPixmap.fromImage(q_image)
-                self.component_widget.setPixmap(self.component_pixmap.scaled(
-                            self.component_widget.size(), Qt.KeepAspectRatio))
-                
-                return component_copy
-            else :
-                self.show_fourier_component_image(component_copy)
-                return component_copy
+            else:
+                painter.drawEllipse(rect_x, rect_y, rect_width, rect_height)
+                if region_shape == 'ring':
+                    painter.drawEllipse(*region_rect(
+                        display.shape[:2], max(value - RING_WIDTH, 0)))
+            painter.end()
+            # Painting detached the QImage from the array, so read it back
+            display = qimage_to_array(q_image)
+        self.component_display.show(display, keep_adjustment=True)
 
     def show_image(self):
         if self.image_processor is not None:
-            # Set an empty pixmap to clear the image
-            self.label_widget.setPixmap(QPixmap())
-            q_image = QImage(self.image_processor.image.data,
-                             self.image_processor.image.shape[1], self.image_processor.image.shape[0], QImage.Format_Grayscale8)
-            pixmap = QPixmap.fromImage(q_image)
-            self.label_widget.setPixmap(pixmap.scaled(
-                self.label_widget.size(), Qt.KeepAspectRatio))
+            # A label-sized thumbnail, not the full working image
+            size = self.label_widget.size()
+            self.image_display.show(
+                self.image_processor.thumbnail(size.width(), size.height()))
 
     def create_q_image(self, component):
-        bytes_per_line = component.shape[1]
-        q_image = QImage(component.data.tobytes(), component.shape[1], component.shape[0],
-                         bytes_per_line, QImage.Format_Grayscale8)
-
-        return q_image
+        return array_to_qimage(component)
 
-    def show_fourier_component_image(self, component):
+    def normalize_component(self, component):
+        # Scale a component to a uint8 image for display
         if self.displayed_component == 'FT Magnitude':
             component = np.log(1+component)
-            component = (component / np.max(component) * 255).astype(np.uint8)
+            component = component / np.max(component) * 255
         else:
             component = (component - np.min(component)) / \
                 (np.max(component) - np.min(component)) * 255
+        component = component.astype(np.uint8)
+        if component.ndim == 3:
+            # Color components are shown with their channels as RGB
+            component = np.ascontiguousarray(component.transpose(1, 2, 0))
+        return component
 
-        q_image = self.create_q_image(component)
-        self.component_pixmap = QPixmap.fromImage(q_image)
-
-        self.component_widget.setPixmap(self.component_pixmap.scaled(
-            self.component_widget.size(), Qt.KeepAspectRatio))
-
-        return q_image
-
-    def change_displayed_component(self, new_component):
-        self.displayed_component = new_component
-        new_component_arr = self.image_processor.get_component(new_component)
-        self.show_fourier_component_image(new_component_arr)
-
-    def browse_image(self):
+    def browse_image(self, color_mode='gray'):
         file_path, _ = QFileDialog.getOpenFileName(
             self.label_widget,
             "Open Image",
@@ -225,56 +379,7 @@ class ImageViewer:
             "Image Files (*.png *.jpg *.bmp);;All Files (*)",
         )
         if file_path:
-            self.image_processor = ImageProcessor(file_path)
-
-class Mixer:
-    def __init__(self):
-        self.weights = [0.0, 0.0, 0.0, 0.0]
-        self.selected_components = [
-            [], [], [], []]
-
-    def set_weights(self, index, value):
-        # Set weight for a specific index
-        self.weights[index] = value / 10.0
-
-    def set_component(self, index, component):
-        # Set component for a specific index
-        self.selected_components[index] = component
-
-    def mix_and_reconstruct(self, comp1, comp2, category):
-        # Reconstruct the mixed image
-        if category == 'Magnitude & Phase':
-            mixed_complex = comp1 * np.exp(1j * comp2)
-        else:
-            mixed_complex = comp1 + 1j * comp2
-
-        mixed_complex = np.fft.ifftshift(mixed_complex)
-        mixed_image = np.fft.ifft2(mixed_complex)
-        mixed_image = np.abs(mixed_image)  # Ensure non-negative values
-        mixed_image -= mixed_image.min()  # Normalize
-        mixed_image = (mixed_image / mixed_image.max()) * 255  # Scale to 0-255
-        mixed_image = mixed_image.astype(np.uint8)
-        return mixed_image
-
-    def mix_images(self, category, selected_components_names):
-        if category == 'Magnitude & Phase':
-            comp1, comp2 = self.create_mixed_components(
-                'FT Magnitude', 'FT Phase', selected_components_names)
-        else:
-            comp1, comp2 = self.create_mixed_components(
-                'FT Real', 'FT Imaginary', selected_components_names)
-        mixed_image = self.mix_and_reconstruct(comp1, comp2, category)
-        return mixed_image
-
-    def create_mixed_components(self, s1, s2, selected_components_names):
-        comp1 = [0.0]*len(self.selected_components[0])
-        comp2 = [0.0]*len(self.selected_components[0])
-        for index, selected_component in enumerate(selected_components_names):
-            if selected_component == s1:
-                comp1 += self.weights[index]*self.selected_components[index]
-            else:
-                comp2 += self.weights[index]*self.selected_components[index]
-        return comp1, comp2
+            self.image_processor = ImageProcessor(file_path, color_mode=color_mode)
 
 class MainApp(QMainWindow, FORM_CLASS):
     def __init__(self, parent=None):
@@ -282,15 +387,17 @@ class MainApp(QMainWindow, FORM_CLASS):
         self.setupUi(self)
         self.progressBar.hide()
 
+        # Region settings shared by the viewers' render graphs
+        self.region_input = Source((0, True, 'rectangle', 'hard'))
         self.image_viewers = [
             ImageViewer(self.image1, self.image1_components,
-                        self.image1_combobox),
+                        self.image1_combobox, self.region_input),
             ImageViewer(self.image2, self.image2_components,
-                        self.image2_combobox),
+                        self.image2_combobox, self.region_input),
             ImageViewer(self.image3, self.image3_components,
-                        self.image3_combobox),
+                        self.image3_combobox, self.region_input),
             ImageViewer(self.image4, self.image4_components,
-                        self.image4_combobox)
+                        self.image4_combobox, self.region_input)
         ]
 
         for index, image_viewer in enumerate(self.image_viewers):
@@ -303,6 +410,10 @@ class MainApp(QMainWindow, FORM_CLASS):
                 event)
             image_viewer_label.mouseDoubleClickEvent = lambda event, viewer=image_viewer: self.mouseDoubleClickEvent(
                 event,viewer,index)
+            component_label = image_viewer.component_display.label_widget
+            component_label.mousePressEvent = image_viewer.component_display.mousePressEvent
+            component_label.mouseMoveEvent = image_viewer.component_display.mouseMoveEvent
+            component_label.mouseReleaseEvent = image_viewer.component_display.mouseReleaseEvent
             
             
         self.image1_combobox.currentTextChanged.connect(
@@ -315,6 +426,39 @@ class MainApp(QMainWindow, FORM_CLASS):
             lambda text: self.change_displayed_component(3, text, self.image_viewers[3]))
 
         self.mixer = Mixer()
+        # Mixer end of the render graph: each viewer's masked component feeds
+        # its mixer slot, and a mix follows weight, region or input changes
+        self.weights_input = Source()
+        self.selection_input = Source()
+        self.mixer_inputs = [
+            Node(lambda masked, index=index: self.set_mixer_component(index, masked), viewer.masked)
+            for index, viewer in enumerate(self.image_viewers)]
+        self.requested_mix = Node(lambda *settings: None, self.weights_input, self.region_input)
+        self.input_mix = Node(lambda *inputs: None, self.selection_input, *self.mixer_inputs)
+        # Changes are gathered and rendered in one pass per event loop turn
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(0)
+        self.render_timer.timeout.connect(self.render)
+
+        # Latest mix per output viewer, and its pixmap scaled to the viewer size
+        self.mixed_images = {}
+        self.mixed_pixmaps = {}
+
+        # Mixing runs on a background thread that reports to the progress bar
+        self.mix_worker = MixWorker(self)
+        self.mix_worker.progress.connect(self.progressBar.setValue)
+        self.mix_worker.mixed.connect(self.on_mixed)
+        self.mix_worker.failed.connect(self.on_mix_failed)
+        self.mix_worker.start()
+
+        # While a slider is dragged, low-resolution previews sized to fit the
+        # target frame time are shown; the full mix follows on release or idle
+        self.preview_scale = 0.25
+        self.full_mix_timer = QTimer(self)
+        self.full_mix_timer.setSingleShot(True)
+        self.full_mix_timer.setInterval(PREVIEW_IDLE_MS)
+        self.full_mix_timer.timeout.connect(self.submit_mix)
 
         # Connect slider value changes to Mixer methods
         self.component1_slider.valueChanged.connect(
@@ -336,12 +480,50 @@ class MainApp(QMainWindow, FORM_CLASS):
         self.radio_btn_draw_rect_shade_inside.toggled.connect(
             self.update_square)
         self.square_size_slider.valueChanged.connect(self.update_square)
+
+        # Region shape (rectangle, circle, ring) and edge (hard or soft) pickers
+        self.region_shape_combobox = QComboBox()
+        self.region_shape_combobox.addItems(REGION_SHAPES)
+        self.region_edge_combobox = QComboBox()
+        self.region_edge_combobox.addItems(REGION_EDGES)
+        self.horizontalLayout_11.addWidget(self.region_shape_combobox)
+        self.horizontalLayout_11.addWidget(self.region_edge_combobox)
+        self.region_shape_combobox.currentTextChanged.connect(self.update_square)
+        self.region_edge_combobox.currentTextChanged.connect(self.update_square)
         # self.apply_button.clicked.connect(self.mix_images)
-        self.component1_slider.valueChanged.connect(self.mix_images)
-        self.component2_slider.valueChanged.connect(self.mix_images)
-        self.component3_slider.valueChanged.connect(self.mix_images)
-        self.component4_slider.valueChanged.connect(self.mix_images)
-        self.square_size_slider.valueChanged.connect(self.mix_images)
+        self.component1_slider.valueChanged.connect(self.schedule_render)
+        self.component2_slider.valueChanged.connect(self.schedule_render)
+        self.component3_slider.valueChanged.connect(self.schedule_render)
+        self.component4_slider.valueChanged.connect(self.schedule_render)
+        self.comboBox_category.currentTextChanged.connect(self.schedule_render)
+        self.mix_sliders = [self.component1_slider, self.component2_slider, self.component3_slider,
+                            self.component4_slider, self.square_size_slider]
+        for slider in self.mix_sliders:
+            slider.sliderReleased.connect(self.mix_images)
+
+        # Gray, RGB or YCbCr mixing; switching reloads the open images
+        self.color_mode_combobox = QComboBox()
+        self.color_mode_combobox.addItems(COLOR_MODE_NAMES)
+        self.horizontalLayout_9.addWidget(self.color_mode_combobox)
+        self.color_mode_combobox.currentTextChanged.connect(self.change_color_mode)
+
+        # Sessions save and restore the slots with their spectra and settings
+        self.session_directory = None
+        session_menu = self.menuBar.addMenu('Session')
+        open_action = session_menu.addAction('Open Session...')
+        open_action.setShortcut(QKeySequence.Open)
+        open_action.triggered.connect(lambda: self.open_session())
+        save_action = session_menu.addAction('Save Session...')
+        save_action.setShortcut(QKeySequence.Save)
+        save_action.triggered.connect(lambda: self.save_session())
+
+        # The initial settings are not a request to mix
+        self.read_settings()
+        self.requested_mix.refresh()
+        self.input_mix.refresh()
+
+    def color_mode(self):
+        return COLOR_MODE_NAMES[self.color_mode_combobox.currentText()]
 
     def mouseDoubleClickEvent(self,event,viewer,index):
         if event.button() == Qt.RightButton:
@@ -350,42 +532,220 @@ class MainApp(QMainWindow, FORM_CLASS):
             self.add_image(index,viewer)
             
     def update_square(self):
+        self.schedule_render()
+
+    def region_settings(self):
+        # (value, out, shape, edge) of the region picked in the widgets
         value = self.square_size_slider.value()
-        for index, viewer in enumerate(self.image_viewers):
-            if viewer.image_processor is not None and viewer.displayed_component:
-                if self.radio_btn_draw_rect_shade_outside.isChecked():
-                    new_component_arr = viewer.apply_draw_rect_shade(
-                        value, True)
-                    self.mixer.set_component(index, new_component_arr)
-
-                elif self.radio_btn_draw_rect_shade_inside.isChecked():
-                    new_component_arr = viewer.apply_draw_rect_shade(
-                        value, False)
-                    self.mixer.set_component(index, new_component_arr)
-
-                elif self.radio_btn_nothing.isChecked():
-                    new_component_arr = viewer.apply_draw_rect_shade(0, True)
-                    self.mixer.set_component(index, new_component_arr)
+        if self.radio_btn_nothing.isChecked() or not (
+                self.radio_btn_draw_rect_shade_outside.isChecked() or
+                self.radio_btn_draw_rect_shade_inside.isChecked()):
+            value = 0
+        return (value, self.radio_btn_draw_rect_shade_outside.isChecked(),
+                self.region_shape_combobox.currentText(),
+                self.region_edge_combobox.currentText())
+
+    def schedule_render(self):
+        # Restarting the zero-delay timer coalesces everything changed in this
+        # event loop turn into a single render
+        self.render_timer.start()
+
+    def read_settings(self):
+        self.region_input.set(self.region_settings())
+        self.weights_input.set(tuple(slider.value() for slider in self.mix_sliders[:4]))
+        self.selection_input.set((self.comboBox_category.currentText(), tuple(
+            viewer.combobox_widget.currentText() for viewer in self.image_viewers)))
+
+    def render(self):
+        # One pass over the render graph: read the settings from the widgets,
+        # then bring every output up to date. Nodes whose inputs did not
+        # change keep their cached values.
+        self.read_settings()
+        if any(viewer.masked.stale() for viewer in self.image_viewers):
+            # The region buffers are rewritten in place below, so a mix still
+            # reading them must not be displayed
+            self.mix_worker.cancel()
+            self.progressBar.hide()
+        for viewer in self.image_viewers:
+            viewer.render()
+
+        requested, inputs = self.requested_mix.version, self.input_mix.version
+        self.requested_mix.refresh()
+        self.input_mix.refresh()
+        if self.requested_mix.version != requested:
+            self.mix_images()
+        elif self.input_mix.version != inputs and self.mixed_images:
+            # Keep a shown mix current, without warnings while a selection is
+            # being edited
+            self.mix_images(warn=False)
+        timing.flush('render')
+
+    def set_mixer_component(self, index, masked):
+        if masked is not None:
+            self.mixer.set_component(index, *masked)
+        else:
+            # An emptied slot (from opening a session) is left out of mixes
+            self.mixer.set_component(index, [])
 
     def add_image(self, index, image_viewer):
-        image_viewer.browse_image()
-        if image_viewer.image_processor is not None:
-            self.resize_images()
-            for viewer in self.image_viewers:
-                viewer.show_image()
-            image_viewer.image_processor.compute_fourier_transform()
-            self.change_displayed_component(
-                index, 'FT Magnitude', image_viewer)
-            self.mixer.set_component(
-                index, image_viewer.image_processor.get_component('FT Magnitude'))
+        previous = image_viewer.image_processor
+        image_viewer.browse_image(self.color_mode())
+        processor = image_viewer.image_processor
+        if processor is not None and processor.image is None:
+            # An unreadable file leaves the slot as it was
+            QMessageBox.warning(self, 'Warning', f'Could not read image: {processor.image_path}')
+            image_viewer.image_processor = previous
+            return
+        if processor is not None:
+            self.load_spectra()
+            image_viewer.displayed_component = 'FT Magnitude'
+
+    def clear_slot(self, viewer):
+        viewer.image_processor = None
+        viewer.masked_component = None
+        viewer.label_widget.clear()
+        viewer.component_widget.clear()
+
+    def load_spectra(self):
+        unreadable = [viewer for viewer in self.image_viewers
+                      if viewer.image_processor is not None and viewer.image_processor.image is None]
+        if unreadable:
+            QMessageBox.warning(self, 'Warning', 'Could not read: ' + ', '.join(
+                str(viewer.image_processor.image_path) for viewer in unreadable))
+            for viewer in unreadable:
+                self.clear_slot(viewer)
+        if all(viewer.image_processor is None for viewer in self.image_viewers):
+            self.schedule_render()
+            return
+        self.resize_images()
+        # Resizing changed every slot; unchanged content hits the spectrum cache
+        # and the rest is transformed in one batched FFT
+        compute_fourier_transforms([viewer.image_processor for viewer in self.image_viewers
+                                    if viewer.image_processor is not None])
+        for viewer in self.image_viewers:
+            if viewer.image_processor is not None:
+                viewer.processor_input.touch()
+        self.schedule_render()
+
+    def session(self):
+        # The slots and settings shown, as a Session
+        if self.radio_btn_draw_rect_shade_outside.isChecked():
+            mode = 'outer'
+        elif self.radio_btn_draw_rect_shade_inside.isChecked():
+            mode = 'inner'
+        else:
+            mode = 'none'
+        return Session(
+            [viewer.image_processor for viewer in self.image_viewers],
+            [viewer.combobox_widget.currentText() for viewer in self.image_viewers],
+            [slider.value() / 10 for slider in self.mix_sliders[:4]],
+            self.comboBox_category.currentText(), self.color_mode(),
+            {'mode': mode, 'size': self.square_size_slider.value(),
+             'shape': self.region_shape_combobox.currentText(),
+             'edge': self.region_edge_combobox.currentText()},
+            {'output_viewer': 2 if self.channel2_radiobutton.isChecked() else 1})
+
+    def save_session(self, directory=None):
+        if directory is None:
+            directory, _ = QFileDialog.getSaveFileName(
+                self, 'Save Session', self.session_directory or '',
+                'Sessions (*.ihsession);;All Files (*)')
+            if not directory:
+                return
+            if not directory.endswith('.ihsession'):
+                directory += '.ihsession'
+        try:
+            save_session(directory, self.session())
+        except OSError as error:
+            QMessageBox.warning(self, 'Warning', f'Could not save the session: {error}')
+            return
+        self.session_directory = directory
+
+    def open_session(self, directory=None):
+        if directory is None:
+            directory = QFileDialog.getExistingDirectory(
+                self, 'Open Session', self.session_directory or '')
+            if not directory:
+                return
+        try:
+            session = load_session(directory)
+        except (OSError, ValueError, KeyError) as error:
+            QMessageBox.warning(self, 'Warning', f'Could not open the session: {error}')
+            return
+        self.session_directory = directory
+
+        # The session's spectra are used as they are: no reload for the
+        # color mode and no resize or FFT for the slots
+        self.color_mode_combobox.blockSignals(True)
+        self.color_mode_combobox.setCurrentText(
+            {mode: name for name, mode in COLOR_MODE_NAMES.items()}[session.color_mode])
+        self.color_mode_combobox.blockSignals(False)
+        self.comboBox_category.setCurrentText(session.category)
+        for viewer, processor, component in zip(
+                self.image_viewers, session.processors, session.components):
+            viewer.image_processor = processor
+            viewer.masked_component = None
+            viewer.combobox_widget.setCurrentText(component)
+            viewer.displayed_component = component
+            if processor is None:
+                viewer.label_widget.clear()
+                viewer.component_widget.clear()
+        for slider, weight in zip(self.mix_sliders, session.weights):
+            slider.setValue(round(weight * 10))
+
+        region = session.region
+        self.radio_btn_draw_rect_shade_inside.setChecked(region.get('mode') == 'inner')
+        self.radio_btn_draw_rect_shade_outside.setChecked(region.get('mode') == 'outer')
+        self.radio_btn_nothing.setChecked(region.get('mode', 'none') == 'none')
+        self.square_size_slider.setValue(region.get('size') or 1)
+        self.region_shape_combobox.setCurrentText(region.get('shape', 'rectangle'))
+        self.region_edge_combobox.setCurrentText(region.get('edge', 'hard'))
+        if session.view.get('output_viewer') == 2:
+            self.channel2_radiobutton.setChecked(True)
+        else:
+            self.channel1_radiobutton.setChecked(True)
+
+        # Mixes of the previous slots are gone, and opening is not a request
+        # to mix (with no mix shown, new inputs do not start one either)
+        self.mix_worker.cancel()
+        self.progressBar.hide()
+        for label_widget in self.mixed_images:
+            label_widget.clear()
+        self.mixed_images.clear()
+        self.mixed_pixmaps.clear()
+        self.read_settings()
+        self.requested_mix.refresh()
+        self.schedule_render()
+
+    def change_color_mode(self):
+        # Slots are reloaded from their files; those that cannot be (such as
+        # a session whose originals were moved) are cleared, since slots in
+        # different color modes cannot be mixed
+        color_mode = self.color_mode()
+        loaded = [viewer for viewer in self.image_viewers if viewer.image_processor is not None]
+        missing = []
+        for viewer in loaded:
+            image_path = viewer.image_processor.image_path
+            processor = None
+            if image_path and path.isfile(image_path):
+                processor = ImageProcessor(image_path, color_mode=color_mode)
+            if processor is None or processor.image is None:
+                missing.append(image_path or f'image {self.image_viewers.index(viewer) + 1}')
+                self.clear_slot(viewer)
+                continue
+            viewer.image_processor = processor
+            viewer.masked_component = None
+        if missing:
+            QMessageBox.warning(self, 'Warning', 'Could not reload in the new color mode, '
+                                'the slots were cleared: ' + ', '.join(missing))
+        if loaded:
+            self.load_spectra()
 
     def change_displayed_component(self, index,  component, image_viewer):
-        if image_viewer.image_processor:
-            image_viewer.change_displayed_component(component)
-        self.mixer.set_component(
-            index, image_viewer.image_processor.get_component(component))
-        self.update_square()
-        
+        # Only this viewer's component, its displays and the mix depend on it
+        image_viewer.displayed_component = component
+        self.schedule_render()
+
     def resize_images(self):
         min_size = self.get_min_size()
         for image_viewer in self.image_viewers:
@@ -393,61 +753,92 @@ class MainApp(QMainWindow, FORM_CLASS):
                 image_viewer.image_processor.resize_image(min_size)
 
     def get_min_size(self):
-        min_size = self.image_viewers[0].image_processor.image.shape
+        # Smallest working (width, height), the order cv2.resize expects; the
+        # originals are kept, so replacing the smallest image lets the rest grow
+        min_size = None
         for image_viewer in self.image_viewers:
             if image_viewer.image_processor:
-                if image_viewer.image_processor.image.shape[0] < min_size[0] and image_viewer.image_processor.image.shape[1] < min_size[1]:
-                    min_size = image_viewer.image_processor.image.shape
-        return min_size
+                shape = image_viewer.image_processor.working_shape
+                if min_size is None or shape[0] < min_size[0] and shape[1] < min_size[1]:
+                    min_size = shape
+        return min_size[1], min_size[0]
+
+    def mix_images(self, warn=True):
+        if any(slider.isSliderDown() for slider in self.mix_sliders):
+            self.full_mix_timer.start()
+            self.submit_mix(self.preview_scale, warn)
+        else:
+            self.full_mix_timer.stop()
+            self.submit_mix(warn=warn)
 
-    def mix_images(self):
+    def submit_mix(self, preview_scale=None, warn=True):
         selected_components = [
             viewer.combobox_widget.currentText() for viewer in self.image_viewers]
-        if all(item == selected_components[0] for item in selected_components):
-            QMessageBox.warning(
-                self, 'Warning', 'The selected components should not be all the same.')
-        elif self.comboBox_category.currentText()== "Magnitude & Phase" and "FT Real" in selected_components:
-            QMessageBox.warning(
-                self, 'Warning', 'The selected components should all be the same category.')
-        elif self.comboBox_category.currentText()== "Magnitude & Phase" and "FT Imaginary" in selected_components:
-            QMessageBox.warning(
-                self, 'Warning', 'The selected components should all be the same category.')
-        elif self.comboBox_category.currentText()== "Real & Imaginary" and "FT Magnitude" in selected_components:
-            QMessageBox.warning(
-                self, 'Warning', 'The selected components should all be the same category.')
-        elif self.comboBox_category.currentText()== "Real & Imaginary" and "FT Phase" in selected_components:
-            QMessageBox.warning(
-                self, 'Warning', 'The selected components should all be the same category.')
+        warning = validate_selection(
+            self.comboBox_category.currentText(), selected_components)
+        if warning:
+            if warn:
+                QMessageBox.warning(self, 'Warning', warning)
+        elif self.mixer.component_shape() is None:
+            # A valid selection with no image loaded has nothing to mix
+            if warn:
+                QMessageBox.warning(self, 'Warning', 'Load an image to mix.')
         else:
-            mixed_image = self.mixer.mix_images(
-                self.comboBox_category.currentText(), selected_components)
-
-            self.display_mixed_image(mixed_image)
+            if preview_scale is None:
+                self.progressBar.setValue(0)
+                self.progressBar.show()
+            self.mix_worker.submit(
+                self.mixer, self.comboBox_category.currentText(), selected_components,
+                preview_scale)
+
+    def on_mixed(self, generation, mixed_image, elapsed, preview):
+        if preview:
+            # Mixing cost grows with the pixel count, so scale each side by the root
+            ratio = (PREVIEW_FRAME_TIME / max(elapsed, 1e-4)) ** 0.5
+            self.preview_scale = min(1.0, max(0.05, self.preview_scale * ratio))
+        # Results of mixes superseded after they finished are dropped too
+        if self.mix_worker.is_current(generation):
+            if not preview:
+                self.progressBar.hide()
+            with timing.stage('display'):
+                self.display_mixed_image(mixed_image)
+            timing.flush(f'mix {generation} shown')
+
+    def on_mix_failed(self, generation, message):
+        if self.mix_worker.is_current(generation):
+            self.progressBar.hide()
 
     def display_mixed_image(self, mixed_image):
         if self.channel1_radiobutton.isChecked():
             label_widget=self.output_viewer1
         else:
             label_widget=self.output_viewer2
-        label_widget.setPixmap(QPixmap())
-        height, width = len(mixed_image), len(mixed_image[0])
-
-        # Create a QPixmap and a QPainter to draw on it
-        pixmap = QPixmap(width, height)
-        pixmap.fill(QColor(255, 255, 255))  # Fill with a white background
-
-        painter = QPainter(pixmap)
-
-        for y in range(height):
-            for x in range(width):
-                pixel_value = mixed_image[y][x]
-                color = QColor(pixel_value, pixel_value, pixel_value)
-                painter.setPen(color)
-                painter.drawPoint(x, y)
-
-        painter.end()
-        label_widget.setPixmap(pixmap.scaled(
-            label_widget.size(), Qt.KeepAspectRatio))
+        self.mixed_images[label_widget] = array_to_qimage(
+            to_rgb(mixed_image, self.color_mode()) if mixed_image.ndim == 3 else mixed_image)
+        self.mixed_pixmaps.pop(label_widget, None)
+        self.show_mixed_image(label_widget)
+
+    def show_mixed_image(self, label_widget):
+        # Scale once per image and widget size, then reuse the cached pixmap
+        q_image = self.mixed_images.get(label_widget)
+        if q_image is None:
+            return
+        size = label_widget.size()
+        cached = self.mixed_pixmaps.get(label_widget)
+        if cached is None or cached[0] != size:
+            pixmap = QPixmap.fromImage(q_image).scaled(size, Qt.KeepAspectRatio)
+            cached = (size, pixmap)
+            self.mixed_pixmaps[label_widget] = cached
+        label_widget.setPixmap(cached[1])
+
+    def resizeEvent(self, event):
+        super(MainApp, self).resizeEvent(event)
+        for label_widget in self.mixed_images:
+            self.show_mixed_image(label_widget)
+
+    def closeEvent(self, event):
+        self.mix_worker.stop()
+        super(MainApp, self).closeEvent(event)
 
     def exit_program(self):
         sys.exit()
@@ -457,6 +848,8 @@ def main():
     app = QApplication(sys.argv)
     window = MainApp()
     window.show()
+    if len(sys.argv) > 1 and is_session(sys.argv[1]):
+        window.open_session(sys.argv[1])
     sys.exit(app.exec_())
 
 
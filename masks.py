@@ -0,0 +1,141 @@
+from functools import lru_cache
+
+import numpy as np
+
+from fft_backends import conjugate_index
+
+# Region masks for the FT components. Masks are built with array operations
+# over normalized, centered coordinates and cached per (shape, settings) key,
+# so moving the region slider back and forth never rebuilds the same mask.
+# Masks are 2D; components of color images are (channels, height, width) and
+# display images (height, width, channels), and both broadcast against them.
+
+REGION_SHAPES = ('rectangle', 'circle', 'ring')
+REGION_EDGES = ('hard', 'gaussian', 'butterworth')
+
+# Width of the ring (band-pass) region, in tenths of the image like the size
+RING_WIDTH = 2
+
+# Selected regions are darkened like a QColor(0, 0, 0, 100) overlay
+SHADE_ALPHA = 100 / 255
+
+
+def region_rect(shape, value):
+    # Centered rectangle covering value/10 of each side, as (x, y, width, height)
+    image_height, image_width = shape
+    rect_width = int(image_width * value/10)
+    rect_height = int(image_height * value/10)
+    rect_x = int((image_width - rect_width)/2)
+    rect_y = int((image_height - rect_height)/2)
+    return rect_x, rect_y, rect_width, rect_height
+
+
+@lru_cache(maxsize=8)
+def _distances(shape, region_shape):
+    # Distance of every pixel from the center, normalized so the image border
+    # is at 1 along both axes (chebyshev for rectangles, euclidean otherwise)
+    height, width = shape
+    y = np.abs(np.arange(height, dtype=np.float32) - height / 2) / (height / 2)
+    x = np.abs(np.arange(width, dtype=np.float32) - width / 2) / (width / 2)
+    if region_shape == 'rectangle':
+        distance = np.maximum(y[:, None], x[None, :])
+    else:
+        distance = np.hypot(y[:, None], x[None, :])
+    distance.flags.writeable = False
+    return distance
+
+
+def _low_pass(distance, cutoff, edge, order):
+    # Fraction of each pixel kept by a low-pass region of radius `cutoff`
+    if edge == 'hard':
+        return distance < cutoff
+    cutoff = max(cutoff, 1e-6)
+    if edge == 'gaussian':
+        return np.exp(-0.5 * (distance / cutoff) ** 2)
+    return 1 / (1 + (distance / cutoff) ** (2 * order))
+
+
+@lru_cache(maxsize=16)
+def region_mask(shape, value, out, region_shape='rectangle', edge='hard',
+                ring_width=RING_WIDTH, order=2):
+    # Mask of the kept frequencies: the region itself (out=False) or everything
+    # but the region (out=True), for a (height, width) shape. Hard masks are
+    # boolean, soft ones float32.
+    if region_shape not in REGION_SHAPES:
+        raise ValueError(f'Unknown region shape: {region_shape}')
+    if edge not in REGION_EDGES:
+        raise ValueError(f'Unknown region edge: {edge}')
+    shape = tuple(shape)
+
+    if region_shape == 'rectangle' and edge == 'hard':
+        # Pixel-exact with the rectangle drawn on the component display
+        rect_x, rect_y, rect_width, rect_height = region_rect(shape, value)
+        mask = np.zeros(shape, dtype=bool)
+        mask[rect_y:rect_y + rect_height, rect_x:rect_x + rect_width] = True
+    else:
+        distance = _distances(shape, region_shape)
+        mask = _low_pass(distance, value / 10, edge, order)
+        if region_shape == 'ring':
+            # Band-pass: the disc of radius value minus the one of value - ring_width
+            inner = _low_pass(distance, max(value - ring_width, 0) / 10, edge, order)
+            mask = mask & ~inner if edge == 'hard' else mask * (1 - inner)
+        if edge != 'hard':
+            mask = mask.astype(np.float32, copy=False)
+
+    if out:
+        mask = ~mask if edge == 'hard' else 1 - mask
+    mask.flags.writeable = False
+    return mask
+
+
+@lru_cache(maxsize=64)
+def region_is_symmetric(shape, value, out, region_shape='rectangle', edge='hard', **kwargs):
+    # Whether the mask keeps the conjugate-symmetric partner of every frequency
+    # it keeps, so masked spectra of real images stay Hermitian
+    if value == 0:
+        return True
+    shape = tuple(shape)
+    mask = region_mask(shape, value, out, region_shape, edge, **kwargs)
+    return bool(np.allclose(mask, mask[conjugate_index(shape)]))
+
+
+def apply_region(component, value, out, region_shape='rectangle', edge='hard',
+                 buffer=None, **kwargs):
+    # Masked component. With value 0 the component itself is returned (callers
+    # never write into it); otherwise the result goes into `buffer` when it
+    # has the right shape and dtype, so repeated calls reuse one allocation.
+    if value == 0:
+        return component
+    if buffer is None or buffer.shape != component.shape or buffer.dtype != component.dtype:
+        buffer = np.empty_like(component)
+
+    if region_shape == 'rectangle' and edge == 'hard':
+        # Only touch the rectangle and what is zeroed, not a full-size mask
+        rect_x, rect_y, rect_width, rect_height = region_rect(component.shape[-2:], value)
+        inner = (Ellipsis, slice(rect_y, rect_y + rect_height),
+                 slice(rect_x, rect_x + rect_width))
+        if out:
+            np.copyto(buffer, component)
+            buffer[inner] = 0
+        else:
+            buffer.fill(0)
+            buffer[inner] = component[inner]
+        return buffer
+
+    mask = region_mask(component.shape[-2:], value, out, region_shape, edge, **kwargs)
+    return np.multiply(component, mask, out=buffer)
+
+
+def shade_region(display, value, out, region_shape='rectangle', edge='hard', **kwargs):
+    # Highlight the selected (kept) part of a uint8 display image in place
+    if value == 0:
+        return display
+    mask = region_mask(display.shape[:2], value, out, region_shape, edge, **kwargs)
+    if edge == 'hard':
+        display[mask] = (display[mask] * (1 - SHADE_ALPHA)).astype(np.uint8)
+    else:
+        shade = 1 - SHADE_ALPHA * mask
+        if display.ndim == 3:
+            shade = shade[:, :, None]
+        np.multiply(display, shade, out=display, casting='unsafe')
+    return display
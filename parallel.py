@@ -0,0 +1,173 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from batch import BatchMixer, job_settings, mix_components, output_path, write_output
+from engine import COMPONENT_FUNCTIONS, SpectrumCache, spectrum_cache
+from fft_backends import PRECISIONS, get_backend
+
+# Parallel batch mixing. The parent computes every source spectrum once and
+# copies it into a shared memory block; pool workers map those blocks
+# read-only, so a task only carries the job settings and block names. Workers
+# derive the components and run the region, mix and inverse FFT stages, and
+# results come back in completion order.
+#
+# The memory cap covers the shared spectra plus an estimated working set per
+# busy worker. Jobs are run in rounds whose spectra fit under the cap, with
+# as many workers as the rest of the cap allows.
+
+# Working set of one task in spectrum-sized arrays: the derived and masked
+# components, the two sums with their scratch buffer, the mixed spectrum and
+# the inverse FFT output
+TASK_SPECTRA = 6
+
+# Blocks this worker process has mapped, by name
+_attached = {}
+_backends = {}
+
+
+def _attach(reference):
+    name, shape, dtype = reference
+    if name not in _attached:
+        block = shared_memory.SharedMemory(name=name)
+        spectrum = np.ndarray(shape, dtype, buffer=block.buf)
+        spectrum.flags.writeable = False
+        _attached[name] = (block, spectrum)
+    return _attached[name][1]
+
+
+def _mix_task(number, settings, references, backend_spec, output):
+    # Runs in a worker: mix one job from the shared spectra
+    started = time.perf_counter()
+    if backend_spec not in _backends:
+        # One thread per worker; the pool provides the parallelism
+        _backends[backend_spec] = get_backend(*backend_spec, workers=1)
+    components = [COMPONENT_FUNCTIONS[name](_attach(reference))
+                  for reference, name in zip(references, settings['components'])]
+    mixed_image = mix_components(components, settings, _backends[backend_spec])
+    if output is not None:
+        write_output(output, mixed_image, settings['color_mode'])
+        mixed_image = None
+    return number, output, mixed_image, time.perf_counter() - started
+
+
+class SharedSpectra:
+    # Spectra copied once into shared memory blocks, owned (and unlinked) here
+    def __init__(self):
+        self.blocks = {}
+        self.nbytes = 0
+
+    def put(self, key, spectrum):
+        if key not in self.blocks:
+            block = shared_memory.SharedMemory(create=True, size=max(spectrum.nbytes, 1))
+            np.ndarray(spectrum.shape, spectrum.dtype, buffer=block.buf)[...] = spectrum
+            self.blocks[key] = (block, spectrum.shape, spectrum.dtype.str)
+            self.nbytes += spectrum.nbytes
+        return self.reference(key)
+
+    def reference(self, key):
+        # What a worker needs to map a block: (name, shape, dtype)
+        block, shape, dtype = self.blocks[key]
+        return block.name, shape, dtype
+
+    def close(self):
+        for block, _, _ in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+        self.nbytes = 0
+
+
+def _plan(manifest, batch_mixer, complex_size, memory_limit):
+    # Split the jobs, in order, into rounds whose shared spectra and one task's
+    # working set fit under the memory cap (a job too big for it runs alone)
+    rounds, current, keys, shared = [], [], set(), 0
+    for number, job in enumerate(manifest['jobs']):
+        settings = job_settings(job, manifest)
+        target_size = batch_mixer.common_size(settings['images'], settings['color_mode'])
+        channels = 1 if settings['color_mode'] == 'gray' else 3
+        spectrum_bytes = target_size[0] * target_size[1] * channels * complex_size
+        new_keys = {(image_path, settings['color_mode'], target_size)
+                    for image_path in settings['images']} - keys
+        needed = shared + len(new_keys) * spectrum_bytes + TASK_SPECTRA * spectrum_bytes
+        if current and needed > memory_limit:
+            rounds.append(current)
+            current, keys, shared = [], set(), 0
+            new_keys = {(image_path, settings['color_mode'], target_size)
+                        for image_path in settings['images']}
+        current.append((number, job, settings, target_size, spectrum_bytes))
+        keys |= new_keys
+        shared += len(new_keys) * spectrum_bytes
+    if current:
+        rounds.append(current)
+    return rounds
+
+
+def mix_parallel(manifest, base_dir='', output_dir=None, backend=None, processes=None,
+                 memory_limit=4 << 30, write=True, batch_mixer=None):
+    # Yield (job number, output path, mixed image, seconds) as jobs complete.
+    # With write=True workers save the outputs and the image is None.
+    # Spectra go to shared memory, so load them through a throwaway cache
+    batch_mixer = batch_mixer or BatchMixer(base_dir, backend, SpectrumCache(0))
+    backend = batch_mixer.backend or get_backend()
+    backend_spec = (backend.name, backend.precision, backend.real)
+    complex_size = np.dtype(PRECISIONS[backend.precision][1]).itemsize
+    processes = processes or os.cpu_count()
+
+    for jobs in _plan(manifest, batch_mixer, complex_size, memory_limit):
+        shared = SharedSpectra()
+        try:
+            tasks = []
+            for number, job, settings, target_size, _ in jobs:
+                keys = [(image_path, settings['color_mode'], target_size)
+                        for image_path in settings['images']]
+                # Only images not yet in shared memory are loaded, so each
+                # spectrum is computed once per round
+                missing = list(dict.fromkeys(key for key in keys if key not in shared.blocks))
+                if missing:
+                    processors = batch_mixer.load([key[0] for key in missing],
+                                                  settings['color_mode'], target_size)
+                    for key, processor in zip(missing, processors):
+                        shared.put(key, processor.spectrum)
+                        # Keep the spectrum in shared memory only (apart from
+                        # what the batch mixer's cache holds on to)
+                        batch_mixer.processors.pop(key, None)
+                references = [shared.reference(key) for key in keys]
+                output = output_path(job, number, base_dir, output_dir) if write else None
+                tasks.append((number, settings, references, backend_spec, output))
+
+            task_bytes = TASK_SPECTRA * max(job[4] for job in jobs)
+            # Spectra still cached in the parent count against the cap too
+            cache = batch_mixer.cache or spectrum_cache
+            resident = shared.nbytes + cache.used_bytes
+            workers = max(1, min(processes, len(tasks),
+                                 (memory_limit - resident) // task_bytes))
+            with ProcessPoolExecutor(workers) as executor:
+                # Keep a bounded number of tasks in flight, so finished images
+                # do not pile up while the parent is still submitting
+                pending = set()
+                for task in tasks:
+                    pending.add(executor.submit(_mix_task, *task))
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+        finally:
+            shared.close()
+
+
+def run_manifest_parallel(manifest, base_dir='', output_dir=None, backend=None,
+                          processes=None, memory_limit=4 << 30, batch_mixer=None):
+    # Per-job mix times, in job order, like batch.run_manifest
+    timings = {}
+    for number, _, _, elapsed in mix_parallel(manifest, base_dir, output_dir, backend,
+                                              processes, memory_limit, batch_mixer=batch_mixer):
+        timings[number] = elapsed
+    return [timings[number] for number in sorted(timings)]
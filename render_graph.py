@@ -0,0 +1,53 @@
+import numpy as np
+
+# Dependency tracking for the GUI's derived data (spectrum, component, masked
+# component, displays, mix). Every node caches its value with the versions of
+# the inputs it was computed from and recomputes only when one of them moved,
+# so a pass over the whole graph only redoes what an edit actually affected.
+
+
+class Source:
+    # An input of the graph, set from outside. Setting an equal value is not a
+    # change; objects changed in place are marked with touch().
+    def __init__(self, value=None):
+        self.value = value
+        self.version = 0
+
+    def set(self, value):
+        if isinstance(value, np.ndarray) or value is not self.value and value != self.value:
+            self.value = value
+            self.version += 1
+
+    def touch(self):
+        self.version += 1
+
+    def refresh(self):
+        return self.version
+
+
+class Node:
+    # A value computed from other nodes or sources, cached until one of them
+    # changes. Recomputing always counts as a change, since outputs may be
+    # buffers rewritten in place.
+    def __init__(self, compute, *inputs):
+        self.compute = compute
+        self.inputs = inputs
+        self.value = None
+        self.version = 0
+        self.seen = None
+
+    def input_versions(self):
+        return tuple(node.refresh() for node in self.inputs)
+
+    def stale(self):
+        # Whether the next refresh recomputes (the inputs are refreshed)
+        return self.input_versions() != self.seen
+
+    def refresh(self):
+        # Bring the value up to date and return its version
+        seen = self.input_versions()
+        if seen != self.seen:
+            self.seen = seen
+            self.value = self.compute(*(node.value for node in self.inputs))
+            self.version += 1
+        return self.version
\ No newline at end of file
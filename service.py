@@ -0,0 +1,470 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+from batch import job_mixer, job_settings
+from engine import (CATEGORY_COMPONENTS, COLOR_CONVERSIONS, COMPONENT_FUNCTIONS, ImageProcessor,
+                    Mixer, SpectrumCache, compute_fourier_transforms, to_bgr)
+from fft_backends import FFT_BACKENDS, PRECISIONS, get_backend
+import timing
+
+# Local mixing service: the engine behind a small HTTP API, on a TCP port or
+# a Unix socket, for tools that mix many images without starting the GUI.
+#
+#     python service.py --port 8765            (or --socket /tmp/harmonize.sock)
+#
+#     POST   /images          body: an encoded image -> {"id", "width", "height"}
+#     GET    /images          uploaded image ids
+#     DELETE /images/<id>
+#     POST   /mix             body: a batch.py job with image ids instead of
+#                             paths (plus "category", "color_mode", "region"
+#                             and "format": "png" | "raw") -> the mixed image
+#     GET    /metrics         latency percentiles, throughput and batching
+#
+# Uploaded images are decoded once. Their spectra and components are kept
+# warm per (image, color mode, size) in an LRU pool, so a mix of known images
+# skips decoding and the forward FFT. One worker thread takes mix requests
+# from a bounded queue and handles those arriving within a short window
+# together: new spectra are computed in one batched forward FFT and the mixed
+# spectra of the same shape in one batched inverse FFT. A full queue is
+# answered with 503 and Retry-After instead of piling up work.
+
+
+class ServiceError(Exception):
+    # An error answered with an HTTP status
+    def __init__(self, status, message):
+        super(ServiceError, self).__init__(message)
+        self.status = status
+
+
+class MixRequest:
+    def __init__(self, job):
+        self.job = job
+        self.received = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.image = None
+        self.color_mode = None
+        self.error = None
+        self.batch_size = 0
+
+
+class Metrics:
+    # Latencies of the most recent requests and running counters
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.started = time.perf_counter()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched = 0
+
+    def record(self, request):
+        with self.lock:
+            if request.error is None:
+                self.completed += 1
+                self.latencies.append((request.finished - request.received,
+                                       request.started - request.received,
+                                       request.finished - request.started))
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = 1000 * np.array(self.latencies).reshape(-1, 3)
+            elapsed = time.perf_counter() - self.started
+            summary = {
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'uptime_s': elapsed,
+                'requests_per_s': self.completed / elapsed if elapsed else 0.0,
+                'batches': self.batches,
+                'mean_batch_size': self.batched / self.batches if self.batches else 0.0,
+            }
+        for column, name in enumerate(('latency', 'queue', 'mix')):
+            for percentile in (50, 90, 99):
+                summary[f'{name}_p{percentile}_ms'] = (
+                    float(np.percentile(latencies[:, column], percentile)) if len(latencies) else 0.0)
+        return summary
+
+
+class MixService:
+    def __init__(self, backend=None, cache_bytes=1 << 30, image_bytes=1 << 30, queue_size=64,
+                 max_batch=16, batch_window=0.002):
+        self.backend = backend or get_backend()
+        self.image_bytes = image_bytes
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        # Decoded uploads (BGR) by id, and their conversions per color mode
+        self.images = {}
+        self.converted = {}
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+        # Spectra and components by (id, color mode, size[, component])
+        self.pool = SpectrumCache(cache_bytes)
+        self.requests = queue.Queue(queue_size)
+        self.metrics = Metrics()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def upload(self, data):
+        image_id = hashlib.blake2b(data, digest_size=8).hexdigest()
+        with self.lock:
+            if image_id in self.images:
+                image = self.images[image_id]
+                return {'id': image_id, 'width': image.shape[1], 'height': image.shape[0]}
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ServiceError(400, 'Could not decode the image.')
+        with self.lock:
+            if self.used_bytes + image.nbytes > self.image_bytes:
+                raise ServiceError(507, 'Image memory is full; delete images first.')
+            if image_id not in self.images:
+                self.images[image_id] = image
+                self.used_bytes += image.nbytes
+        return {'id': image_id, 'width': image.shape[1], 'height': image.shape[0]}
+
+    def delete(self, image_id):
+        with self.lock:
+            if image_id not in self.images:
+                raise ServiceError(404, f'Unknown image: {image_id}')
+            self.used_bytes -= self.images.pop(image_id).nbytes
+            for key in [key for key in self.converted if key[0] == image_id]:
+                self.used_bytes -= self.converted.pop(key).nbytes
+        # Pooled spectra of the image age out of the LRU pool
+
+    def image(self, image_id, color_mode):
+        # An uploaded image in a color mode, converted once
+        with self.lock:
+            if image_id not in self.images:
+                raise ServiceError(404, f'Unknown image: {image_id}')
+            key = (image_id, color_mode)
+            if key not in self.converted:
+                code = cv2.COLOR_BGR2GRAY if color_mode == 'gray' else COLOR_CONVERSIONS[color_mode][0]
+                converted = cv2.cvtColor(self.images[image_id], code)
+                self.converted[key] = converted
+                self.used_bytes += converted.nbytes
+            return self.converted[key]
+
+    def submit(self, job):
+        # Queue a mix and wait for it; a full queue is rejected right away
+        request = MixRequest(job)
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            with self.metrics.lock:
+                self.metrics.rejected += 1
+            raise ServiceError(503, 'Too many pending mixes.')
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self.requests.get(timeout=max(remaining, 0))
+                                 if remaining > 0 else self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.mix_batch(batch)
+            except Exception as error:
+                # This is the only mixing thread: fail the batch, not the service
+                for request in batch:
+                    if not request.done.is_set():
+                        request.error = ServiceError(500, f'Mix failed: {error}')
+                        request.done.set()
+
+    def prepare(self, request):
+        # Settings, slot keys and image size of a request
+        job = request.job
+        try:
+            settings = job_settings(job, job)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ServiceError(400, f'Invalid job: {error}')
+        if not all(isinstance(image_id, str) for image_id in settings['images']):
+            raise ServiceError(400, 'Invalid job: images must be image ids.')
+        images = [self.image(image_id, settings['color_mode']) for image_id in settings['images']]
+        height, width = min((image.shape[:2] for image in images),
+                            key=lambda shape: shape[0] * shape[1])
+        keys = [(image_id, settings['color_mode'], (width, height))
+                for image_id in settings['images']]
+        return settings, keys, images
+
+    def warm(self, prepared):
+        # Compute the spectra of the batch's new (image, mode, size) slots in
+        # batched forward FFTs, and pool them
+        processors = {}
+        for _, keys, images in prepared:
+            for key, image in zip(keys, images):
+                if key in processors or self.pool.get(key) is not None:
+                    continue
+                if image.shape[1::-1] != key[2]:
+                    image = cv2.resize(image, key[2], interpolation=cv2.INTER_AREA)
+                # A throwaway cache: the pool is keyed by id, not content
+                processors[key] = ImageProcessor(image=image, cache=SpectrumCache(0),
+                                                 backend=self.backend, color_mode=key[1])
+        if processors:
+            compute_fourier_transforms(list(processors.values()))
+            for key, processor in processors.items():
+                self.pool.put(key, processor.spectrum)
+
+    def component(self, key, name):
+        component = self.pool.get(key + (name,))
+        if component is None:
+            spectrum = self.pool.get(key)
+            if spectrum is None:
+                # Evicted by a large batch in the meantime
+                self.warm([(None, [key], [self.image(key[0], key[1])])])
+                spectrum = self.pool.get(key)
+            component = self.pool.put(key + (name,), COMPONENT_FUNCTIONS[name](spectrum))
+        return component
+
+    def mixed_spectrum(self, settings, keys):
+        # Mixed spectrum of a request and whether it is Hermitian; the
+        # inverse FFT is left to the batch
+        components = [self.component(key, name)
+                      for key, name in zip(keys, settings['components'])]
+        mixer = job_mixer(components, settings, self.backend)
+        category = settings['category']
+        comp1, comp2 = mixer.create_mixed_components(*CATEGORY_COMPONENTS[category],
+                                                     settings['components'])
+        return mixer.mixed_spectrum(comp1, comp2, category)
+
+    def mix_batch(self, batch):
+        started = time.perf_counter()
+        prepared, pending = [], []
+        for request in batch:
+            request.started = started
+            request.batch_size = len(batch)
+            try:
+                prepared.append(self.prepare(request))
+                pending.append(request)
+            except ServiceError as error:
+                request.error = error
+
+        # Mixed spectra grouped by (shape, hermitian, output size), each group
+        # inverted in one batched FFT. Half spectra of widths 2k and 2k + 1
+        # have the same shape, so the output size is part of the key.
+        groups = {}
+        try:
+            with timing.stage('fft'):
+                self.warm(prepared)
+            for request, (settings, keys, _) in zip(pending, prepared):
+                try:
+                    spectrum, hermitian = self.mixed_spectrum(settings, keys)
+                except ServiceError as error:
+                    request.error = error
+                    continue
+                except (IndexError, TypeError, ValueError) as error:
+                    request.error = ServiceError(400, f'Invalid job: {error}')
+                    continue
+                request.color_mode = settings['color_mode']
+                group_key = (spectrum.shape, hermitian, keys[0][2])
+                groups.setdefault(group_key, []).append((request, spectrum))
+            with timing.stage('mix_and_reconstruct'):
+                for (_, hermitian, size), group in groups.items():
+                    stack = np.stack([spectrum for _, spectrum in group])
+                    images = Mixer(self.backend).reconstruct(
+                        stack, size[::-1], hermitian, tuple(range(1, stack.ndim)))
+                    for (request, _), image in zip(group, images):
+                        if image.ndim == 3:
+                            image = np.ascontiguousarray(image.transpose(1, 2, 0))
+                        request.image = image
+        except Exception as error:
+            for request in pending:
+                if request.image is None and request.error is None:
+                    request.error = ServiceError(500, f'Mix failed: {error}')
+        timing.flush(f'batch of {len(batch)}')
+
+        with self.metrics.lock:
+            self.metrics.batches += 1
+            self.metrics.batched += len(batch)
+        for request in batch:
+            request.finished = time.perf_counter()
+            self.metrics.record(request)
+            request.done.set()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Largest accepted request body
+    max_body = 256 << 20
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(Handler, self).log_message(format, *args)
+
+    def send(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > self.max_body:
+            raise ServiceError(413, 'Request body too large.')
+        return self.rfile.read(length)
+
+    def handle_errors(self, method):
+        try:
+            method()
+        except ServiceError as error:
+            headers = {'Retry-After': '1'} if error.status == 503 else None
+            self.send(error.status, {'error': str(error)}, headers=headers)
+
+    def do_GET(self):
+        self.handle_errors(self.get)
+
+    def do_POST(self):
+        self.handle_errors(self.post)
+
+    def do_DELETE(self):
+        self.handle_errors(self.delete)
+
+    def get(self):
+        service = self.server.service
+        route = urlparse(self.path).path
+        if route == '/metrics':
+            summary = service.metrics.snapshot()
+            summary['queued'] = service.requests.qsize()
+            summary['pool_mb'] = service.pool.used_bytes / 2 ** 20
+            summary['images_mb'] = service.used_bytes / 2 ** 20
+            self.send(200, summary)
+        elif route == '/images':
+            with service.lock:
+                self.send(200, sorted(service.images))
+        else:
+            raise ServiceError(404, f'Unknown route: {route}')
+
+    def post(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        if url.path == '/images':
+            self.send(201, service.upload(self.body()))
+        elif url.path == '/mix':
+            try:
+                job = json.loads(self.body())
+            except ValueError:
+                raise ServiceError(400, 'The job is not valid JSON.')
+            if not isinstance(job, dict):
+                raise ServiceError(400, 'The job has to be a JSON object.')
+            output_format = job.get('format', parse_qs(url.query).get('format', ['png'])[0])
+            request = service.submit(job)
+            headers = {
+                'X-Queue-Ms': f'{1000 * (request.started - request.received):.2f}',
+                'X-Mix-Ms': f'{1000 * (request.finished - request.started):.2f}',
+                'X-Batch-Size': str(request.batch_size),
+            }
+            if output_format == 'raw':
+                headers['X-Shape'] = ','.join(map(str, request.image.shape))
+                self.send(200, request.image.tobytes(), 'application/octet-stream', headers)
+            else:
+                _, encoded = cv2.imencode('.png', to_bgr(request.image, request.color_mode))
+                self.send(200, encoded.tobytes(), 'image/png', headers)
+        else:
+            raise ServiceError(404, f'Unknown route: {url.path}')
+
+    def delete(self):
+        route = urlparse(self.path).path
+        if not route.startswith('/images/'):
+            raise ServiceError(404, f'Unknown route: {route}')
+        self.server.service.delete(route[len('/images/'):])
+        self.send(204)
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host='127.0.0.1', port=8765, socket_path=None, verbose=False):
+    # The HTTP server for a started service (call serve_forever on it)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the mixing engine over local HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of a TCP port.')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='Pending mixes beyond which requests get 503.')
+    parser.add_argument('--max-batch', type=int, default=16, help='Mixes handled together.')
+    parser.add_argument('--batch-window-ms', type=float, default=2.0,
+                        help='How long the first mix of a batch waits for others.')
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help='Memory budget of the warm spectrum pool in MiB.')
+    parser.add_argument('--images-mb', type=int, default=1024,
+                        help='Memory budget of uploaded images in MiB.')
+    parser.add_argument('--fft', choices=sorted(FFT_BACKENDS), default='numpy')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double')
+    parser.add_argument('--workers', type=int, help='Threads for the scipy/pyfftw engines.')
+    parser.add_argument('--timing', action='store_true',
+                        help='Log the time of every stage per batch.')
+    parser.add_argument('--verbose', action='store_true', help='Log every request.')
+    args = parser.parse_args(argv)
+    if args.timing:
+        timing.enable()
+
+    service = MixService(get_backend(args.fft, args.precision, workers=args.workers),
+                         args.cache_mb << 20, args.images_mb << 20, args.queue_size,
+                         args.max_batch, args.batch_window_ms / 1000).start()
+    server = serve(service, args.host, args.port, args.socket, args.verbose)
+    where = args.socket or '%s:%d' % server.server_address[:2]
+    print(f'serving on {where}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
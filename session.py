@@ -0,0 +1,167 @@
+import json
+import os
+from os import makedirs, path
+
+import numpy as np
+
+from engine import ImageProcessor
+
+# Saved sessions: the four slots with their working images and spectra, plus
+# the component selections, weights and region, so a session reopens without
+# decoding or transforming anything.
+#
+# A session is a directory:
+#     session.json           settings and slots (see below)
+#     image0.npy ...         working image of each loaded slot
+#     spectrum0.npy ...      its shifted spectrum
+# Arrays are plain uncompressed .npy files and are memory-mapped read-only
+# on load, so opening costs the same for any image size; pages are read when
+# the arrays are first used.
+#
+# session.json holds the batch manifest keys ("category", "color_mode",
+# "region") and one entry per slot:
+#     {"image_path": "a.jpg", "image": "image0.npy", "spectrum": "spectrum0.npy",
+#      "content_key": "...", "working_shape": [h, w],
+#      "component": "FT Magnitude", "weight": 0.3}
+# with only "component" and "weight" for empty slots. batch.py accepts a
+# session directory in place of a manifest and mixes its slots from the
+# saved spectra.
+
+SESSION_FILE = 'session.json'
+SESSION_FORMAT = 'imageharmonize-session'
+SESSION_VERSION = 1
+
+
+class Session:
+    def __init__(self, processors, components, weights, category='Magnitude & Phase',
+                 color_mode='gray', region=None, view=None, directory=None):
+        # One entry per slot; processors are None for empty slots. `view`
+        # holds GUI-only state (such as the output viewer) as plain JSON.
+        self.processors = list(processors)
+        self.components = list(components)
+        self.weights = [float(weight) for weight in weights]
+        self.category = category
+        self.color_mode = color_mode
+        self.region = dict(region or {'mode': 'none'})
+        self.view = dict(view or {})
+        self.directory = directory
+
+    def slot_id(self, index):
+        # Name of a loaded slot in manifests: its original file when known
+        processor = self.processors[index]
+        if processor.image_path:
+            return processor.image_path
+        return path.join(self.directory or '', f'image{index}.npy')
+
+    def loaded(self):
+        return [index for index, processor in enumerate(self.processors) if processor is not None]
+
+    def manifest(self, output='session_mix.png'):
+        # A batch manifest with one job mixing the loaded slots
+        loaded = self.loaded()
+        return {
+            'category': self.category,
+            'color_mode': self.color_mode,
+            'region': dict(self.region),
+            'jobs': [{
+                'images': [self.slot_id(index) for index in loaded],
+                'components': [self.components[index] for index in loaded],
+                'weights': [self.weights[index] for index in loaded],
+                'output': output,
+            }],
+        }
+
+
+def _save_array(directory, name, array):
+    # Write through a temporary file and rename, so arrays memory-mapped from
+    # the previous save of this session stay valid; an array that already is
+    # that file is left alone
+    file_path = path.join(directory, name)
+    if isinstance(array, np.memmap) and array.filename and \
+            path.abspath(array.filename) == path.abspath(file_path):
+        return
+    temporary = file_path + '.tmp'
+    with open(temporary, 'wb') as array_file:
+        np.save(array_file, np.ascontiguousarray(array))
+    os.replace(temporary, file_path)
+
+
+def save_session(directory, session):
+    makedirs(directory, exist_ok=True)
+    slots = []
+    for index, processor in enumerate(session.processors):
+        slot = {'component': session.components[index], 'weight': session.weights[index]}
+        if processor is not None:
+            if processor.spectrum is None:
+                processor.compute_fourier_transform()
+            _save_array(directory, f'image{index}.npy', processor.image)
+            _save_array(directory, f'spectrum{index}.npy', processor.spectrum)
+            slot.update({
+                'image_path': processor.image_path and path.abspath(processor.image_path),
+                'image': f'image{index}.npy',
+                'spectrum': f'spectrum{index}.npy',
+                'content_key': processor.cache.key(processor.image),
+                'working_shape': list(processor.working_shape or processor.image.shape),
+            })
+        slots.append(slot)
+
+    # Arrays of slots that are empty now
+    for index, processor in enumerate(session.processors):
+        if processor is None:
+            for name in (f'image{index}.npy', f'spectrum{index}.npy'):
+                if path.exists(path.join(directory, name)):
+                    os.remove(path.join(directory, name))
+
+    settings = {
+        'format': SESSION_FORMAT,
+        'version': SESSION_VERSION,
+        'category': session.category,
+        'color_mode': session.color_mode,
+        'region': session.region,
+        'slots': slots,
+        'view': session.view,
+    }
+    temporary = path.join(directory, SESSION_FILE + '.tmp')
+    with open(temporary, 'w') as session_file:
+        json.dump(settings, session_file, indent=2)
+    os.replace(temporary, path.join(directory, SESSION_FILE))
+    session.directory = directory
+
+
+def is_session(directory):
+    return path.isfile(path.join(directory, SESSION_FILE))
+
+
+def load_session(directory, backend=None, cache=None):
+    # Session with processors over memory-mapped images and spectra. The
+    # spectra also go into the spectrum cache under their saved content keys,
+    # so batching them with new images later does not transform them again.
+    with open(path.join(directory, SESSION_FILE)) as session_file:
+        settings = json.load(session_file)
+    if settings.get('format') != SESSION_FORMAT:
+        raise ValueError(f'Not a session: {directory}')
+    if settings.get('version', 0) > SESSION_VERSION:
+        raise ValueError(f"Session version {settings['version']} is newer than this program.")
+
+    color_mode = settings.get('color_mode', 'gray')
+    processors = []
+    for slot in settings['slots']:
+        if 'spectrum' not in slot:
+            processors.append(None)
+            continue
+        image = np.load(path.join(directory, slot['image']), mmap_mode='r')
+        spectrum = np.load(path.join(directory, slot['spectrum']), mmap_mode='r')
+        processor = ImageProcessor(image=image, cache=cache, backend=backend,
+                                   color_mode=color_mode)
+        processor.image_path = slot.get('image_path')
+        processor.working_shape = tuple(slot.get('working_shape', image.shape))
+        processor.set_spectrum(spectrum)
+        if slot.get('content_key') and spectrum.dtype == processor.backend.complex_dtype:
+            processor.cache.put((slot['content_key'], processor.backend.key), spectrum)
+        processors.append(processor)
+
+    return Session(processors,
+                   [slot['component'] for slot in settings['slots']],
+                   [slot['weight'] for slot in settings['slots']],
+                   settings.get('category', 'Magnitude & Phase'), color_mode,
+                   settings.get('region'), settings.get('view'), directory)
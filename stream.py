@@ -0,0 +1,387 @@
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+from os import makedirs, path
+
+import cv2
+import numpy as np
+
+from batch import job_settings
+from engine import CATEGORY_COMPONENTS, COLOR_CONVERSIONS, ImageProcessor, Mixer, to_bgr
+from fft_backends import FFT_BACKENDS, PRECISIONS, get_backend
+from masks import apply_region, region_is_symmetric
+import timing
+
+# Streaming mode: mixes video files or numbered frame directories frame by
+# frame, like batch.py does for still images.
+#
+#     python stream.py --slot clip.mp4 "FT Magnitude" 0.8 \
+#                      --slot frames/ "FT Phase" 1.0 \
+#                      --slot texture.png "FT Magnitude" 0.2 -o mixed.mp4
+#
+# The pipeline is a chain of generators, decode -> FFT -> region mask,
+# weighted mix and inverse FFT -> encode, each running in its own thread and
+# handing frames to the next through a bounded queue, so decoding and encoding
+# overlap the transforms. Still images (and slots marked --static) are
+# transformed and masked once; their component is reused for every frame.
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+# Codecs for video outputs by extension; anything else is a frame directory
+VIDEO_CODECS = {'.avi': 'MJPG', '.mp4': 'mp4v'}
+
+
+class FrameSource:
+    # Frames of one slot: a video file, a directory of numbered images, or a
+    # still image (which is static). Frames are BGR, as decoded by cv2.
+    def __init__(self, source_path, static=False):
+        self.path = source_path
+        self.capture = None
+        self.files = None
+        self.fps = None
+        if path.isdir(source_path):
+            names = [name for name in os.listdir(source_path)
+                     if name.lower().endswith(IMAGE_EXTENSIONS)]
+            # Natural order, so frame_10 comes after frame_9
+            names.sort(key=lambda name: [int(part) if part.isdigit() else part
+                                         for part in re.split(r'(\d+)', name)])
+            self.files = iter([path.join(source_path, name) for name in names])
+        elif source_path.lower().endswith(IMAGE_EXTENSIONS):
+            static = True
+            self.files = iter([source_path])
+        else:
+            self.capture = cv2.VideoCapture(source_path)
+            if not self.capture.isOpened():
+                raise ValueError(f'Could not open video: {source_path}')
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or None
+        self.static = static
+        self.first = self.read()
+        if self.first is None:
+            raise ValueError(f'No frames in: {source_path}')
+
+    def read(self):
+        # Next frame, or None at the end
+        if self.capture is not None:
+            ok, frame = self.capture.read()
+            return frame if ok else None
+        for file_path in self.files:
+            frame = cv2.imread(file_path, cv2.IMREAD_COLOR)
+            if frame is not None:
+                return frame
+        return None
+
+    def frames(self):
+        yield self.first
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+
+
+def convert_frame(frame, color_mode, size, out=None):
+    # BGR frame at (width, height) in the color mode, written into `out`
+    if frame.shape[1::-1] != tuple(size):
+        frame = cv2.resize(frame, tuple(size), interpolation=cv2.INTER_AREA)
+    code = cv2.COLOR_BGR2GRAY if color_mode == 'gray' else COLOR_CONVERSIONS[color_mode][0]
+    return cv2.cvtColor(frame, code, dst=out)
+
+
+def channels_first(image):
+    return image.transpose(2, 0, 1) if image.ndim == 3 else image
+
+
+def component_into(name, spectrum, out):
+    # FT component of a spectrum written into a reused buffer
+    if name == 'FT Magnitude':
+        return np.abs(spectrum, out=out)
+    if name == 'FT Phase':
+        return np.arctan2(spectrum.imag, spectrum.real, out=out)
+    np.copyto(out, spectrum.real if name == 'FT Real' else spectrum.imag)
+    return out
+
+
+class Stage:
+    # Wall time spent in a stage's own work, and the frames it handled
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.frames = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self.started
+        self.frames += 1
+
+
+_END = object()
+
+
+def threaded(items, maxsize):
+    # Run an iterator in its own thread, handing its items over through a
+    # bounded queue. Errors are re-raised in the consumer, and closing the
+    # consumer stops the producer.
+    handoff = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_END)
+        except BaseException as error:
+            put(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = handoff.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class StreamMixer:
+    def __init__(self, sources, settings, size=None, backend=None, queue_size=4):
+        self.sources = sources
+        self.settings = settings
+        self.color_mode = settings['color_mode']
+        self.backend = backend or get_backend()
+        self.queue_size = queue_size
+        if size is None:
+            # The smallest slot sets the frame size, like in the GUI
+            height, width = min((source.first.shape[:2] for source in sources),
+                                key=lambda shape: shape[0] * shape[1])
+            size = (width, height)
+        self.size = tuple(size)
+        self.dynamic = [index for index, source in enumerate(sources) if not source.static]
+        if not self.dynamic:
+            raise ValueError('At least one slot has to be a video or frame directory.')
+        self.stages = {name: Stage(name) for name in ('decode', 'fft', 'mix', 'encode')}
+
+        value, out = self.region()
+        self.mixer = Mixer(self.backend)
+        self.components = {}
+        self.masked = {}
+        for index, source in enumerate(sources):
+            self.mixer.weights[index] = float(settings['weights'][index])
+            if source.static:
+                # Transformed and masked once, then reused for every frame
+                processor = ImageProcessor(
+                    image=convert_frame(source.first, self.color_mode, self.size),
+                    backend=self.backend, color_mode=self.color_mode)
+                processor.compute_fourier_transform()
+                component = processor.get_component(settings['components'][index])
+                self.set_component(index, apply_region(
+                    component, value, out, settings['region_shape'], settings['edge']))
+
+    def region(self):
+        # (value, out) of the job's region; value 0 keeps everything
+        mode = self.settings['mode']
+        return (0 if mode == 'none' else self.settings['size']), mode == 'outer'
+
+    def set_component(self, index, component):
+        value, out = self.region()
+        self.mixer.set_component(index, component, region_is_symmetric(
+            component.shape[-2:], value, out, self.settings['region_shape'],
+            self.settings['edge']))
+
+    def decode(self, max_frames=None):
+        # Frame sets of the dynamic slots, stacked, in a ring of buffers large
+        # enough that a buffer is only rewritten once the next stage is done
+        # with it (a full queue, the frame in use downstream and this one)
+        width, height = self.size
+        shape = (len(self.dynamic), height, width) + ((3,) if self.color_mode != 'gray' else ())
+        ring = [np.empty(shape, np.uint8) for _ in range(self.queue_size + 2)]
+        frames = zip(*[self.sources[index].frames() for index in self.dynamic])
+        for number, frame_set in enumerate(frames):
+            if max_frames is not None and number >= max_frames:
+                return
+            with self.stages['decode']:
+                buffer = ring[number % len(ring)]
+                for slot, frame in enumerate(frame_set):
+                    convert_frame(frame, self.color_mode, self.size, out=buffer[slot])
+            yield number, buffer
+
+    def transform(self, frame_sets):
+        # One batched forward FFT per frame set, channels first
+        for number, frames in frame_sets:
+            with self.stages['fft']:
+                stack = frames.transpose(0, 3, 1, 2) if frames.ndim == 4 else frames
+                spectra = self.backend.forward(stack)
+            yield number, spectra
+
+    def mix(self, spectra_sets):
+        # Component, region mask, weighted mix and inverse FFT; the component
+        # and mask buffers and the mixer's sums are reused for every frame
+        value, out = self.region()
+        category, names = self.settings['category'], self.settings['components']
+        for number, spectra in spectra_sets:
+            with self.stages['mix']:
+                for slot, index in enumerate(self.dynamic):
+                    spectrum = spectra[slot]
+                    if index not in self.components:
+                        self.components[index] = np.empty(spectrum.shape, spectrum.real.dtype)
+                    component = component_into(names[index], spectrum, self.components[index])
+                    masked = apply_region(component, value, out, self.settings['region_shape'],
+                                          self.settings['edge'], buffer=self.masked.get(index))
+                    if value != 0:
+                        self.masked[index] = masked
+                    self.set_component(index, masked)
+                mixed_image = self.mixer.mix_images(category, names)
+            timing.flush(f'frame {number}')
+            yield number, mixed_image
+
+    def encode(self, mixed_frames, output, fps):
+        # Write the mixed frames to a video file or numbered images, and yield
+        # the frame numbers as they are written
+        extension = path.splitext(output)[1].lower()
+        writer = None
+        if extension in VIDEO_CODECS:
+            if path.dirname(output):
+                makedirs(path.dirname(output), exist_ok=True)
+            writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*VIDEO_CODECS[extension]),
+                                     fps, self.size, self.color_mode != 'gray')
+            if not writer.isOpened():
+                raise ValueError(f'Could not open video for writing: {output}')
+        else:
+            makedirs(output, exist_ok=True)
+        try:
+            for number, mixed_image in mixed_frames:
+                with self.stages['encode']:
+                    frame = to_bgr(mixed_image, self.color_mode)
+                    if writer is not None:
+                        writer.write(frame)
+                    else:
+                        cv2.imwrite(path.join(output, f'{number:06d}.png'), frame)
+                yield number
+        finally:
+            if writer is not None:
+                writer.release()
+
+    def run(self, output, fps=None, max_frames=None, report_every=2.0):
+        # Run the whole pipeline; returns the summary
+        fps = fps or next((source.fps for source in self.sources if source.fps), 25.0)
+        pipeline = self.decode(max_frames)
+        for stage in (self.transform, self.mix):
+            pipeline = stage(threaded(pipeline, self.queue_size))
+        pipeline = self.encode(threaded(pipeline, self.queue_size), output, fps)
+
+        started = time.perf_counter()
+        last_report, frames = started, 0
+        for number in pipeline:
+            frames = number + 1
+            now = time.perf_counter()
+            if report_every and now - last_report >= report_every:
+                print(f'frame {frames}: {frames / (now - started):.1f} fps', flush=True)
+                last_report = now
+        total = time.perf_counter() - started
+        return summarize(frames, total, self.stages.values())
+
+
+def summarize(frames, total, stages):
+    return {
+        'frames': frames,
+        'total_s': total,
+        'fps': frames / total if total else 0.0,
+        'stage_ms': {stage.name: 1000 * stage.seconds / stage.frames if stage.frames else 0.0
+                     for stage in stages},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Mix videos or frame sequences frame by frame without the GUI.')
+    parser.add_argument('--slot', nargs=3, action='append', required=True,
+                        metavar=('PATH', 'COMPONENT', 'WEIGHT'),
+                        help='A video, numbered frame directory or still image, the FT '
+                             'component taken from it and its weight (0 to 1). Up to four.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Output video (.mp4, .avi) or directory for numbered PNG frames.')
+    parser.add_argument('--static', type=int, nargs='+', default=[],
+                        help='Slots (from 0) whose first frame is used for every frame.')
+    parser.add_argument('--category', choices=sorted(CATEGORY_COMPONENTS),
+                        default='Magnitude & Phase')
+    parser.add_argument('--color-mode', choices=['gray', 'rgb', 'ycbcr'], default='gray')
+    parser.add_argument('--region', nargs='+', metavar='MODE [SIZE SHAPE EDGE]',
+                        default=['none'], help='e.g. "inner 4 circle gaussian"')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='Frame size (default: the smallest slot).')
+    parser.add_argument('--fps', type=float, help='Output frame rate (default: the first video).')
+    parser.add_argument('--max-frames', type=int)
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='Frames buffered between pipeline stages.')
+    parser.add_argument('--fft', choices=sorted(FFT_BACKENDS), default='numpy')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double')
+    parser.add_argument('--workers', type=int, help='Threads for the scipy/pyfftw engines.')
+    parser.add_argument('--report', help='Write the summary as JSON to this path.')
+    parser.add_argument('--timing', action='store_true',
+                        help='Log the time of every mixing stage per frame.')
+    args = parser.parse_args(argv)
+    if args.timing:
+        timing.enable()
+
+    region = dict(zip(('mode', 'size', 'shape', 'edge'), args.region))
+    if 'size' in region:
+        region['size'] = int(region['size'])
+    job = {
+        'images': [slot[0] for slot in args.slot],
+        'components': [slot[1] for slot in args.slot],
+        'weights': [float(slot[2]) for slot in args.slot],
+        'region': region,
+    }
+    settings = job_settings(job, {'category': args.category, 'color_mode': args.color_mode})
+    backend = get_backend(args.fft, args.precision, workers=args.workers)
+
+    sources = [FrameSource(slot[0], index in args.static) for index, slot in enumerate(args.slot)]
+    try:
+        stream_mixer = StreamMixer(sources, settings, args.size, backend, args.queue_size)
+        startup = time.perf_counter() - _START
+        summary = stream_mixer.run(args.output, args.fps, args.max_frames)
+    finally:
+        for source in sources:
+            source.close()
+    summary['startup_s'] = startup
+
+    print(f"startup: {summary['startup_s'] * 1000:.1f} ms")
+    print(f"frames: {summary['frames']} in {summary['total_s']:.2f} s ({summary['fps']:.1f} fps; "
+          + ', '.join(f'{name} {ms:.1f} ms' for name, ms in summary['stage_ms'].items())
+          + ' per frame)')
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
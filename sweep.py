@@ -0,0 +1,322 @@
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import itertools
+import json
+import sys
+from os import makedirs, path
+
+import cv2
+import numpy as np
+
+from batch import BatchMixer, job_settings
+from engine import CATEGORY_COMPONENTS, normalize, to_bgr
+from fft_backends import FFT_BACKENDS, PRECISIONS, get_backend, half_index
+from loader import fit_size
+from masks import REGION_EDGES, REGION_SHAPES, region_is_symmetric, region_mask
+
+# Parameter sweeps: a grid of mixes over many weight vectors and regions.
+#
+#     python sweep.py a.jpg b.jpg --components "FT Magnitude" "FT Phase" \
+#                     --weights 0:1:11 1 --region inner circle gaussian \
+#                     --sizes 1 2 3 4 5 6 7 8 9 10 -o sheet.png
+#
+# The weighted sums are linear, so a region mask can be applied to the sums
+# instead of each component: mask * sum(w * c) == sum(w * (mask * c)). Each
+# chunk of weight vectors costs one matrix product per component kind over
+# the stacked components, a broadcast multiply per region and one batched
+# inverse FFT over all of the chunk's mixes, instead of a full
+# Mixer.mix_images call per result.
+#
+# The inverse FFT is linear too. The mixed spectrum is linear in the
+# magnitude weights (for a fixed phase sum) and in all weights for Real &
+# Imaginary, so when a chunk has fewer distinct (phase vector, linear
+# component) pairs than mixes, only those are inverted and every mix is a
+# weighted sum of the resulting images.
+
+# Bytes of working memory per mix in a chunk, in units of one real component:
+# the masked sums, the mixed spectrum (complex), the inverse FFT output and
+# its normalized copy
+MIX_ARRAYS = 7
+
+
+def weight_grid(values):
+    # Every combination of per-slot weight values, as an (N, slots) array
+    return np.array(list(itertools.product(*values)), dtype=np.float64).reshape(-1, len(values))
+
+
+def parse_weights(spec):
+    # "0.5" or "start:stop:count" (inclusive, like np.linspace)
+    if ':' in spec:
+        start, stop, count = spec.split(':')
+        return list(np.linspace(float(start), float(stop), int(count)))
+    return [float(spec)]
+
+
+def sweep_mask(shape, region):
+    # Mask of a (value, out, shape, edge) region; value 0 keeps everything
+    if region[0] == 0:
+        return np.ones(shape, dtype=bool)
+    return region_mask(shape, *region)
+
+
+def combine(category, comp1, comp2, index1, index2):
+    # Mixed spectra of every weight vector from the masked sums of the
+    # distinct weight vectors of each kind, so exp(1j * phase) is computed
+    # once per distinct phase vector
+    if category == 'Magnitude & Phase':
+        return comp1[:, index1] * rotation(comp2)[:, index2]
+    mixed_complex = np.empty(comp1.shape[:1] + index1.shape + comp1.shape[2:],
+                             np.result_type(comp1.dtype, np.complex64))
+    mixed_complex.real = comp1[:, index1]
+    mixed_complex.imag = comp2[:, index2]
+    return mixed_complex
+
+
+def rotation(phase):
+    # exp(1j * phase), as cos and sin written into a complex array
+    result = np.empty(phase.shape, np.result_type(phase.dtype, np.complex64))
+    np.cos(phase, out=result.real)
+    np.sin(phase, out=result.imag)
+    return result
+
+
+def mix_direct(category, sums, indices, masks, backend, hermitian, shape):
+    # Invert every mix of the chunk in one batched FFT
+    mixed_complex = combine(category, sums[0][None] * masks, sums[1][None] * masks, *indices)
+    if hermitian:
+        return backend.inverse_half(mixed_complex, shape)
+    return backend.inverse(mixed_complex)
+
+
+def mix_linear(category, stacked, selected, weights, sums, indices, masks, backend, hermitian,
+               shape):
+    # Invert one image per region, distinct phase vector and linear
+    # component, then form every mix as a weighted sum of those images
+    masks = masks[:, :, None]
+    if category == 'Magnitude & Phase':
+        linear = np.flatnonzero(selected[0])
+        # (regions, phase vectors, magnitude slots, [channels,] height, width)
+        spectra = stacked[linear] * masks * rotation(sums[1][None] * masks[:, :, 0])[:, :, None]
+        groups = indices[1]
+    else:
+        # Real components as they are, imaginary ones times 1j
+        linear = np.arange(len(stacked))
+        factors = np.where(selected[0], 1, 1j).reshape((-1,) + (1,) * (stacked.ndim - 1))
+        spectra = (stacked * factors) * masks
+        groups = np.zeros(len(weights), dtype=int)
+    if hermitian:
+        basis = backend.inverse_half(spectra, shape)
+    else:
+        basis = backend.inverse(spectra)
+    # The weighted sums only feed 8-bit images, so single precision is plenty
+    basis = basis.reshape(basis.shape[:3] + (-1,)).astype(
+        np.complex64 if np.iscomplexobj(basis) else np.float32, copy=False)
+
+    mixed = np.empty((len(basis), len(weights), basis.shape[-1]), basis.dtype)
+    for group in range(basis.shape[1]):
+        rows = np.flatnonzero(groups == group)
+        # (weights, linear) @ (regions, linear, pixels) -> (regions, weights, pixels)
+        mixed[:, rows] = weights[rows][:, linear].astype(basis.real.dtype) @ basis[:, group]
+    return mixed.reshape(mixed.shape[:2] + stacked.shape[1:-2] + tuple(shape))
+
+
+def sweep(components, names, category, weights, regions=((0, False, 'rectangle', 'hard'),),
+          backend=None, memory_limit=512 << 20):
+    # Mix every weight vector (rows of `weights`, one column per component)
+    # with every region (value, out, shape, edge), yielding chunks as
+    # (region indices, weight indices, images) where images is a uint8
+    # (regions, weights, height, width[, channels]) stack in the layout of
+    # Mixer.mix_images' results.
+    backend = backend or get_backend()
+    weights = np.asarray(weights, dtype=np.float64)
+    s1, s2 = CATEGORY_COMPONENTS[category]
+    stack = np.stack(components)
+    shape = stack.shape[-2:]
+    channels = stack.shape[1:-2]
+    # The inverse of a real image's spectrum can use irfft2 on half of it,
+    # for the regions whose masks keep the spectrum Hermitian
+    symmetric = [region_is_symmetric(shape, *region) for region in regions]
+    groups = [[index for index in range(len(regions)) if symmetric[index] == flag]
+              for flag in (True, False)]
+    selected = [np.array([name == s for name in names]) for s in (s1, s2)]
+    # Weight vectors with the same phase weights next to each other, so the
+    # chunks share as many phase sums as possible
+    order = np.lexsort((weights * selected[1]).T[::-1])
+
+    for hermitian, group in zip((True, False), groups):
+        if not group:
+            continue
+        hermitian = hermitian and backend.real
+        stacked = stack[(Ellipsis,) + half_index(shape)] if hermitian else stack
+        flat = stacked.reshape(len(stacked), -1)
+        real_bytes = stacked[0].size * flat.itemsize
+        # Weight vectors per chunk, and regions mixed together with them
+        count = max(1, min(len(weights), memory_limit // (2 * real_bytes * (1 + MIX_ARRAYS))))
+        per_batch = max(1, min(len(group), memory_limit // (MIX_ARRAYS * real_bytes * count)))
+
+        for start in range(0, len(weights), count):
+            chunk = order[start:start + count]
+            # Distinct weight vectors of each component kind: a sweep over
+            # magnitude weights shares the phase sums, and the other way round
+            distinct = [np.unique(weights[chunk] * kind, axis=0, return_inverse=True)
+                        for kind in selected]
+            indices = [index.reshape(-1) for _, index in distinct]
+            if category == 'Magnitude & Phase':
+                transforms = len(distinct[1][0]) * np.count_nonzero(selected[0])
+            else:
+                transforms = len(stacked)
+            linear = transforms < len(chunk)
+            # Their weighted sums as matrix products (only the phase sums are
+            # needed when inverting per component)
+            sums = [None if linear and (kind == 0 or category != 'Magnitude & Phase')
+                    else (vectors.astype(flat.dtype) @ flat).reshape((-1,) + stacked.shape[1:])
+                    for kind, (vectors, _) in enumerate(distinct)]
+            for batch_start in range(0, len(group), per_batch):
+                batch = group[batch_start:batch_start + per_batch]
+                masks = np.stack([sweep_mask(shape, regions[index]) for index in batch])
+                if hermitian:
+                    masks = masks[(Ellipsis,) + half_index(shape)]
+                # Broadcast to (regions, weights, [channels,] height, width)
+                masks = masks.reshape((len(batch), 1) + (1,) * len(channels) + masks.shape[-2:])
+                if linear:
+                    mixed = mix_linear(category, stacked, selected, weights[chunk], sums, indices,
+                                       masks, backend, hermitian, shape)
+                else:
+                    mixed = mix_direct(category, sums, indices, masks, backend, hermitian, shape)
+                images = normalize(np.abs(mixed) if np.iscomplexobj(mixed) else mixed,
+                                   tuple(range(2, mixed.ndim)))
+                if channels:
+                    images = np.ascontiguousarray(np.moveaxis(images, 2, -1))
+                yield batch, chunk, images
+
+
+class StackWriter:
+    # Collects sweep chunks into a contact sheet (.png/.jpg), a .npy stack
+    # written through a memory map, or a directory of PNGs
+    def __init__(self, output, region_count, weight_count, image_shape, color_mode,
+                 cell_size=(160, 160), gap=2):
+        self.output = output
+        self.color_mode = color_mode
+        self.kind = path.splitext(output)[1].lower()
+        if path.dirname(output):
+            makedirs(path.dirname(output), exist_ok=True)
+        if self.kind == '.npy':
+            self.stack = np.lib.format.open_memmap(
+                output, 'w+', np.uint8, (region_count, weight_count) + tuple(image_shape))
+        elif self.kind in ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff'):
+            # Regions down the rows, weight vectors across the columns
+            self.cell = fit_size(image_shape, *cell_size)
+            self.gap = gap
+            width, height = self.cell
+            self.sheet = np.full((region_count * (height + gap) - gap,
+                                  weight_count * (width + gap) - gap) + tuple(image_shape[2:]),
+                                 255, np.uint8)
+        else:
+            self.kind = None
+            makedirs(output, exist_ok=True)
+
+    def add(self, region_indices, weight_indices, images):
+        for row, region in enumerate(region_indices):
+            for column, weight in enumerate(weight_indices):
+                image = images[row, column]
+                if self.kind == '.npy':
+                    self.stack[region, weight] = image
+                elif self.kind is None:
+                    cv2.imwrite(path.join(self.output, f'r{region:02d}_w{weight:05d}.png'),
+                                to_bgr(image, self.color_mode))
+                else:
+                    width, height = self.cell
+                    top, left = region * (height + self.gap), weight * (width + self.gap)
+                    self.sheet[top:top + height, left:left + width] = cv2.resize(
+                        image, self.cell, interpolation=cv2.INTER_AREA)
+
+    def close(self):
+        if self.kind == '.npy':
+            self.stack.flush()
+            del self.stack
+        elif self.kind is not None:
+            cv2.imwrite(self.output, to_bgr(self.sheet, self.color_mode))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Mix a grid of weight vectors and region sizes in batched inverse FFTs.')
+    parser.add_argument('images', nargs='+', help='Up to four images.')
+    parser.add_argument('--components', nargs='+', required=True,
+                        help='The FT component taken from each image.')
+    parser.add_argument('--weights', nargs='+', required=True,
+                        help='Per image, a weight or START:STOP:COUNT; every combination is mixed.')
+    parser.add_argument('--category', choices=sorted(CATEGORY_COMPONENTS),
+                        default='Magnitude & Phase')
+    parser.add_argument('--color-mode', choices=['gray', 'rgb', 'ycbcr'], default='gray')
+    parser.add_argument('--region', nargs=3, metavar=('MODE', 'SHAPE', 'EDGE'),
+                        default=['none', 'rectangle', 'hard'],
+                        help=f"inner or outer, one of {', '.join(REGION_SHAPES)} and "
+                             f"one of {', '.join(REGION_EDGES)}.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5],
+                        help='Region sizes (1-10) to sweep.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Contact sheet (.png, .jpg), image stack (.npy) or PNG directory.')
+    parser.add_argument('--cell-size', type=int, nargs=2, default=[160, 160],
+                        metavar=('WIDTH', 'HEIGHT'), help='Largest cell of the contact sheet.')
+    parser.add_argument('--memory-mb', type=int, default=512,
+                        help='Working memory of one chunk of mixes in MiB.')
+    parser.add_argument('--fft', choices=sorted(FFT_BACKENDS), default='numpy')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double')
+    parser.add_argument('--workers', type=int, help='Threads for the scipy/pyfftw engines.')
+    parser.add_argument('--report', help='Write the timing summary as JSON to this path.')
+    args = parser.parse_args(argv)
+
+    mode, region_shape, edge = args.region
+    job = {'images': args.images, 'components': args.components,
+           'weights': [0.0] * len(args.images),
+           'region': {'mode': mode, 'shape': region_shape, 'edge': edge}}
+    settings = job_settings(job, {'category': args.category, 'color_mode': args.color_mode})
+    if len(args.weights) != len(args.images):
+        parser.error('--weights needs one value or range per image.')
+    weights = weight_grid([parse_weights(spec) for spec in args.weights])
+    if mode == 'none':
+        regions = [(0, False, region_shape, edge)]
+    else:
+        regions = [(size, mode == 'outer', region_shape, edge) for size in args.sizes]
+    backend = get_backend(args.fft, args.precision, workers=args.workers)
+
+    batch_mixer = BatchMixer(backend=backend)
+    target_size = batch_mixer.common_size(args.images, args.color_mode)
+    processors = batch_mixer.load(args.images, args.color_mode, target_size)
+    components = [processor.get_component(name)
+                  for processor, name in zip(processors, args.components)]
+    startup = time.perf_counter() - _START
+
+    image_shape = processors[0].image.shape
+    writer = StackWriter(args.output, len(regions), len(weights), image_shape,
+                         args.color_mode, args.cell_size)
+    started = time.perf_counter()
+    for region_indices, weight_indices, images in sweep(
+            components, args.components, args.category, weights, regions, backend,
+            args.memory_mb << 20):
+        writer.add(region_indices, weight_indices, images)
+    writer.close()
+    total = time.perf_counter() - started
+    mixes = len(regions) * len(weights)
+
+    summary = {
+        'startup_s': startup,
+        'mixes': mixes,
+        'total_s': total,
+        'mixes_per_s': mixes / total if total else 0.0,
+    }
+    print(f"startup: {summary['startup_s'] * 1000:.1f} ms")
+    print(f"mixes: {len(regions)} regions x {len(weights)} weight vectors = {mixes} in "
+          f"{total:.2f} s ({summary['mixes_per_s']:.1f} mixes/s)")
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
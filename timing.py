@@ -0,0 +1,56 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Optional per-stage timing of the mixing pipeline. Stages are timed only while
+# enabled (IMAGEHARMONIZE_TIMING=1 in the environment, or enable()), so the
+# hot paths otherwise pay one flag check. Timings are collected per thread and
+# logged together by flush(), e.g. once per mix.
+
+logger = logging.getLogger('imageharmonize.timing')
+enabled = False
+_local = threading.local()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+    if on:
+        logger.setLevel(logging.INFO)
+        if not logger.handlers and not logging.getLogger().handlers:
+            logging.basicConfig(format='%(message)s')
+
+
+def _records():
+    if not hasattr(_local, 'records'):
+        _local.records = []
+    return _local.records
+
+
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _records().append((name, time.perf_counter() - started))
+
+
+def flush(label):
+    # Log and clear the stages timed on this thread since the last flush, and
+    # return them as (name, seconds) pairs
+    records = list(_records())
+    _records().clear()
+    if records:
+        logger.info('%s: %s', label, ', '.join(
+            f'{name} {1000 * seconds:.2f} ms' for name, seconds in records))
+    return records
+
+
+if os.environ.get('IMAGEHARMONIZE_TIMING', '0') not in ('', '0'):
+    enable()